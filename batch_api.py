@@ -0,0 +1,92 @@
+import re
+
+from team_engine import TeamConstraints, make_teams
+
+# --- チーム分けの一括 API (POST /api/make_teams) ---
+# リクエスト:
+#   {"time_budget": 0.3,
+#    "rosters": [{"id": "lobby-1",
+#                 "members": {"名前": パワー, ...},          (10人)
+#                 "history": [[[チーム1の名前...], [チーム2の名前...]], ...],   (古い順、省略可)
+#                 "same": [["A", "B"]], "diff": [["C", "D"]], "captains": ["E", "F"],   (省略可)
+#                 "roles": {"名前": {"powers": {"TOP": 60}, "prefs": ["TOP"]}}, "off_role_penalty": 10},   (省略可)
+#                ...]}
+# レスポンス: {"results": [{"id", "team1", "team2", "diff", "repeat_score", "explored", "total", "lanes"}, ...]}
+#   ロスターごとに入力と同じ順で返し、チーム分けできないロスターは {"id", "error"} になる
+# 各ロスターはプロセスプールに渡すため、ここの関数は pickle できる引数だけを受け取る
+
+# JSON の数値 (整数か、50.0 のように整数値の小数) と整数の文字列だけを受け付ける。
+# true / 1.5 / 1e400 (inf) / "+-5" / "²" などは ValueError にする
+INT_PATTERN = re.compile(r"[+-]?[0-9]+")
+
+def _int(value, message):
+    if isinstance(value, bool):
+        raise ValueError(message)
+    if isinstance(value, int):
+        return value
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str) and INT_PATTERN.fullmatch(value.strip()):
+        return int(value)
+    raise ValueError(message)
+
+def _name_groups(roster, key):
+    groups = roster.get(key) or []
+    if not isinstance(groups, list) or not all(isinstance(group, list) for group in groups):
+        raise ValueError(f"{key} は名前のリストのリストで指定してください")
+    return [[str(name) for name in group] for group in groups]
+
+def _parse_roles(roles):
+    if not isinstance(roles, dict):
+        raise ValueError("roles は {名前: {powers, prefs}} で指定してください")
+    parsed = {}
+    for name, role in roles.items():
+        if not isinstance(role, dict):
+            raise ValueError("roles の各要素は {powers, prefs} で指定してください")
+        powers = role.get('powers') or {}
+        prefs = role.get('prefs') or []
+        if not isinstance(powers, dict) or not isinstance(prefs, list):
+            raise ValueError("powers は {レーン: パワー}、prefs はレーンのリストで指定してください")
+        powers = {str(lane).upper(): _int(power, "パワーは整数で指定してください") for lane, power in powers.items()}
+        parsed[str(name)] = {'powers': powers, 'prefs': [str(lane).upper() for lane in prefs]}
+    return parsed
+
+def parse_roster(roster):
+    if not isinstance(roster, dict):
+        raise ValueError("ロスターはオブジェクトで指定してください")
+    members = roster.get('members')
+    if not isinstance(members, dict):
+        raise ValueError("members は {名前: パワー} で指定してください")
+    members = {str(name): _int(power, "パワーは整数で指定してください") for name, power in members.items()}
+    entries = roster.get('history') or []
+    if not isinstance(entries, list):
+        raise ValueError("history は [チーム1, チーム2] のリストで指定してください")
+    history = []
+    for entry in entries:
+        if not isinstance(entry, list) or len(entry) != 2 or not all(isinstance(team, list) for team in entry):
+            raise ValueError("history の各要素は [チーム1, チーム2] で指定してください")
+        history.append((frozenset(map(str, entry[0])), frozenset(map(str, entry[1]))))
+    captains = roster.get('captains') or []
+    if not isinstance(captains, list):
+        raise ValueError("captains は名前のリストで指定してください")
+    constraints = TeamConstraints(_name_groups(roster, 'same'), _name_groups(roster, 'diff'), map(str, captains))
+    roles = roster.get('roles')
+    if roles is not None:
+        roles = _parse_roles(roles)
+    off_role_penalty = _int(roster.get('off_role_penalty') or 0, "off_role_penalty は整数で指定してください")
+    return {
+        'names': sorted(members),
+        'members': members,
+        'history': history,
+        'constraints': constraints,
+        'roles': roles,
+        'off_role_penalty': off_role_penalty,
+    }
+
+def roster_result(roster, time_budget):
+    roster_id = roster.get('id') if isinstance(roster, dict) else None
+    try:
+        result = make_teams(time_budget=time_budget, **parse_roster(roster))
+    except ValueError as e:
+        return {'id': roster_id, 'error': str(e)}
+    return {**result, 'id': roster_id, 'team1': sorted(result['team1']), 'team2': sorted(result['team2'])}
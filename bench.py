@@ -0,0 +1,149 @@
+# --- チーム分けのベンチマーク ---
+# Discord / Flask / 保存先を起動せずに team_engine だけを読み込み、
+# 合成した参加者・パワー分布・履歴長で各処理の所要時間を計測して JSON で出力する。
+#   python bench.py --output report.json
+#   python bench.py --compare baseline.json   (閾値を超えて遅くなった項目があれば終了コード1)
+import argparse
+import json
+import platform
+import random
+import statistics
+import sys
+import time
+
+from team_engine import (LANES, HistoryIndex, LaneAssigner, TEAM_SIZE, TeamConstraints, canonical_splits,
+                         constrained_splits, decide_swap, make_lobbies, mask_to_teams, rank_splits)
+
+POWER_DISTRIBUTIONS = {
+    'uniform': lambda rng: rng.randint(0, 100),
+    'normal': lambda rng: max(0, int(rng.gauss(50, 15))),
+    'skewed': lambda rng: int(100 * rng.random() ** 3),
+    'equal': lambda rng: 50,
+}
+
+def synthetic_roster(size, distribution, rng):
+    names = [str(100000000000000000 + i) for i in range(size)]
+    return names, {n: POWER_DISTRIBUTIONS[distribution](rng) for n in names}
+
+def synthetic_history(names, length, rng, team_size=TEAM_SIZE):
+    history = []
+    for _ in range(length):
+        picked = rng.sample(names, team_size * 2)
+        history.append((frozenset(picked[:team_size]), frozenset(picked[team_size:])))
+    return history
+
+# レーン別パワーは基本パワー ±20、希望レーンは2つ
+def synthetic_roles(names, members, rng):
+    return {n: {'powers': {lane: max(0, members[n] + rng.randint(-20, 20)) for lane in LANES},
+                'prefs': rng.sample(LANES, 2)} for n in names}
+
+def measure(func, repeat):
+    func()
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - start) * 1000)
+    samples.sort()
+    return {
+        'runs': repeat,
+        'mean_ms': statistics.fmean(samples),
+        'median_ms': statistics.median(samples),
+        'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+        'min_ms': samples[0],
+    }
+
+def run_benchmarks(repeat, seed, history_lengths, lobby_sizes):
+    rng = random.Random(seed)
+    results = []
+
+    def record(name, params, func, runs=repeat):
+        results.append({'name': name, 'params': params, **measure(func, runs)})
+
+    for distribution in POWER_DISTRIBUTIONS:
+        for history_length in history_lengths:
+            names, members = synthetic_roster(10, distribution, rng)
+            history = synthetic_history(names, history_length, rng)
+            # よく出る分割を履歴に混ぜ、重複スコアが0にならない状況も測る
+            history += [mask_to_teams(names, mask) for mask, _ in canonical_splits(10)[:history_length // 2]]
+            params = {'players': 10, 'distribution': distribution, 'history': len(history)}
+            index = HistoryIndex(history)
+            record('history_index_build', params, lambda: HistoryIndex(history))
+            record('make_teams_candidates', params,
+                   lambda: rank_splits(names, members, k=5, repeat_score=index.mask_scorer(names)))
+            # 制約付きは列挙の段階で枝を刈るため、制約なしより速くなるはず
+            constraints = TeamConstraints(same=[names[1:3]], diff=[names[3:5]], captains=names[5:7])
+            record('make_teams_candidates_constrained', params,
+                   lambda: rank_splits(names, members, k=5, repeat_score=index.mask_scorer(names),
+                                       splits=constrained_splits(names, TEAM_SIZE, constraints)))
+            roles = synthetic_roles(names, members, rng)
+            record('make_teams_candidates_roles', params,
+                   lambda: rank_splits(names, members, k=5, repeat_score=index.mask_scorer(names),
+                                       team_strength=LaneAssigner(names, members, roles, 10).strength))
+            splits = [mask_to_teams(names, mask) for mask, _ in canonical_splits(10)]
+            record('member_repeat_score', {**params, 'candidates': len(splits)},
+                   lambda: [index.repeat_score(t1, t2) for t1, t2 in splits])
+            prev = history[-1] if history else splits[0]
+            record('decide_swap', {**params, 'candidates': len(splits)},
+                   lambda: [decide_swap(t1, t2, prev[0], prev[1]) for t1, t2 in splits])
+
+    for size in lobby_sizes:
+        names, members = synthetic_roster(size, 'normal', rng)
+        history = synthetic_history(names, 10, rng)
+        index = HistoryIndex(history)
+        outcome = {}
+
+        def lobbies():
+            outcome['result'] = make_lobbies(names, members, index, tolerance=10, rng=random.Random(seed))
+
+        record('make_lobbies', {'players': size, 'distribution': 'normal', 'history': len(history)},
+               lobbies, runs=max(1, repeat // 20))
+        results[-1]['explored'] = outcome['result']['explored']
+        results[-1]['diffs'] = outcome['result']['diffs']
+    return results
+
+# 基準のレポートと比べ、中央値が threshold 倍を超えて遅くなった項目を返す
+def find_regressions(results, baseline, threshold):
+    def key(entry):
+        return entry['name'], json.dumps(entry['params'], sort_keys=True)
+
+    base = {key(entry): entry for entry in baseline['results']}
+    regressions = []
+    for entry in results:
+        before = base.get(key(entry))
+        if before and entry['median_ms'] > before['median_ms'] * threshold:
+            regressions.append({**entry, 'baseline_median_ms': before['median_ms']})
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="チーム分け処理のベンチマーク")
+    parser.add_argument("--repeat", type=int, default=200, help="各項目の計測回数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--history", type=int, nargs="+", default=[0, 5, 10, 50], help="履歴の長さ")
+    parser.add_argument("--lobby-sizes", type=int, nargs="*", default=[20, 30, 40], help="複数ロビー分けの人数")
+    parser.add_argument("--output", help="レポートの出力先 (省略時は標準出力)")
+    parser.add_argument("--compare", help="比較する基準のレポート")
+    parser.add_argument("--threshold", type=float, default=1.25, help="遅くなったと判定する倍率")
+    args = parser.parse_args(argv)
+
+    report = {
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'results': run_benchmarks(args.repeat, args.seed, args.history, args.lobby_sizes),
+    }
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            report['regressions'] = find_regressions(report['results'], json.load(f), args.threshold)
+
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 1 if report.get('regressions') else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
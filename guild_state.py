@@ -0,0 +1,145 @@
+import asyncio
+import itertools
+import time
+from collections import deque
+
+from storage import HISTORY_WINDOW
+from team_engine import HistoryIndex
+
+DEFAULT_POWER_DIFF_TOLERANCE = 10
+DEFAULT_INITIAL_POWER = 50
+DEFAULT_OFF_ROLE_PENALTY = 10
+
+# --- 履歴の累計 ---
+# 保存先には全履歴が残るが、メモリには直近の HISTORY_WINDOW 件と次の累計だけを持つ。
+# matches: 名前 -> 試合数 / pairs: (名前a, 名前b) -> 同じチームになった回数 (a < b)
+class HistoryStats:
+    def __init__(self, matches=None, pairs=None):
+        self.matches = matches or {}
+        self.pairs = pairs or {}
+
+    # 累計を更新し、保存先に送る変更分 {('matches', 名前): 値, ('pairs', 名前a, 名前b): 値} を返す
+    def add(self, entries, step=1):
+        changes = {}
+        for team1, team2 in entries:
+            for name in itertools.chain(team1, team2):
+                self.matches[name] = changes['matches', name] = self.matches.get(name, 0) + step
+            for team in (team1, team2):
+                for pair in itertools.combinations(sorted(team), 2):
+                    self.pairs[pair] = changes[('pairs',) + pair] = self.pairs.get(pair, 0) + step
+        return changes
+
+    def remove(self, entries):
+        return self.add(entries, step=-1)
+
+    def teammates(self, name):
+        counts = {}
+        for (a, b), count in self.pairs.items():
+            if not count:
+                continue
+            if a == name:
+                counts[b] = count
+            elif b == name:
+                counts[a] = count
+        return counts
+
+# --- ギルドごとの状態 ---
+# 登録メンバー・ロール (レーン別パワーと希望レーン)・参加者・履歴 (直近の一定件数)・履歴の累計・設定・
+# 募集メッセージをギルド単位で保持する
+class GuildState:
+    def __init__(self, guild_id, members=None, history=(), settings=None, stats=None, roles=None):
+        self.guild_id = guild_id
+        self.members = members or {}
+        self.roles = roles or {}
+        self.participants = set()
+        self.history = deque(((frozenset(t[0]), frozenset(t[1])) for t in history), maxlen=HISTORY_WINDOW)
+        self.history_index = HistoryIndex(self.history)
+        # 履歴が変わるたびに増やす (引き直し用の候補キャッシュの無効化に使う)
+        self.history_version = 0
+        self.stats = stats or HistoryStats()
+        self.settings = settings or {}
+        # 参加者を募集メッセージの 👍 と突き合わせ済みの募集メッセージ (再起動後に一度だけ行う)
+        self.synced_recruit_messages = set()
+        # 表示名の準備 (メンバー一覧の取得・登録メンバーの問い合わせ) を始めたか
+        self.names_ready = False
+        # 直前のチーム分けの残りの候補 (/reroll 用)
+        self.roll_cache = None
+        self.last_used = time.monotonic()
+
+    @property
+    def power_diff_tolerance(self):
+        return self.settings.get('power_diff_tolerance', DEFAULT_POWER_DIFF_TOLERANCE)
+
+    @property
+    def initial_power(self):
+        return self.settings.get('initial_power', DEFAULT_INITIAL_POWER)
+
+    # 有効なら make_teams でレーン割り当てを含めてバランスを取る
+    @property
+    def role_mode(self):
+        return self.settings.get('role_mode', False)
+
+    @property
+    def off_role_penalty(self):
+        return self.settings.get('off_role_penalty', DEFAULT_OFF_ROLE_PENALTY)
+
+    # {チャンネルID: 募集メッセージID}。有効な募集メッセージはギルドで1つだけで、/recruit のたびに置き換える。
+    # 再起動後もリアクションを受け付けられるよう settings に保存する
+    @property
+    def recruit_messages(self):
+        return self.settings.get('recruit_messages', {})
+
+    def is_recruit_message(self, channel_id, message_id):
+        return self.recruit_messages.get(str(channel_id)) == message_id
+
+    # 履歴を追加し、保存先に送る累計の変更分を返す
+    def add_history(self, entries):
+        self.history.extend(entries)
+        self.history_index = HistoryIndex(self.history)
+        self.history_version += 1
+        return self.stats.add(entries)
+
+    # 直前の履歴を置き換え (引き直し)、保存先に送る累計の変更分を返す
+    def replace_last_history(self, entry):
+        changes = self.stats.remove([self.history[-1]])
+        self.history[-1] = entry
+        self.history_index = HistoryIndex(self.history)
+        self.history_version += 1
+        changes.update(self.stats.add([entry]))
+        return changes
+
+# --- 状態のキャッシュ ---
+# 初めてコマンドが使われたときに loader(guild_id) で読み込み (executor 上で実行)、
+# 一定時間使われず参加者もいないギルドは evict_idle で破棄する
+class GuildStateCache:
+    def __init__(self, loader, idle_timeout=3600, executor=None):
+        self.loader = loader
+        self.idle_timeout = idle_timeout
+        self.executor = executor
+        self.states = {}
+        self._loading = {}
+
+    async def get(self, guild_id):
+        state = self.states.get(guild_id)
+        if state is None:
+            # 同じギルドの読み込みが重なった場合は1回の読み込みを共有する
+            task = self._loading.get(guild_id)
+            if task is None:
+                loop = asyncio.get_running_loop()
+                task = loop.run_in_executor(self.executor, self.loader, guild_id)
+                self._loading[guild_id] = task
+            try:
+                state = await asyncio.shield(task)
+            finally:
+                self._loading.pop(guild_id, None)
+            state = self.states.setdefault(guild_id, state)
+        state.last_used = time.monotonic()
+        return state
+
+    def evict_idle(self, keep=lambda guild_id: False):
+        deadline = time.monotonic() - self.idle_timeout
+        evicted = [guild_id for guild_id, state in self.states.items()
+                   if state.last_used < deadline and not state.participants and not keep(guild_id)]
+        for guild_id in evicted:
+            del self.states[guild_id]
+        return evicted
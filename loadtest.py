@@ -0,0 +1,551 @@
+# --- 負荷試験 (リプレイ) ---
+# Discord と Firebase に接続せず、main.py の実際のコマンド処理に大量のイベントを流して計測する。
+# Firebase は firebase_admin.db の reference() を真似たメモリ上の FakeDatabase、
+# Discord はギルド・チャンネル・インタラクションなどの最小限の偽物で置き換える。
+# イベント列はランダムに作る (募集 → 参加 → チーム分け → 引き直し の流れをギルドごとに繰り返す) か、
+# --script の JSON Lines を読み込む。各イベントは予定時刻に開始し (処理の遅れは待ち時間に含まれる)、
+# 種類ごとの待ち時間の分布・スループット・イベントループの停止時間を JSON で出力する。
+# スラッシュコマンドは最初の応答 (send_message / defer) までの時間も計測し、
+# Discord の応答期限 (3秒) を過ぎたもの・応答しなかったものはエラーとして数える。
+#   python loadtest.py --guilds 20 --events 5000 --rate 500
+#   python loadtest.py --save-script stream.jsonl   (作ったイベント列を保存する)
+#   python loadtest.py --script stream.jsonl
+#   python loadtest.py --no-warmup   (プロセスプールの起動も含めて計測する)
+import argparse
+import asyncio
+import copy
+import itertools
+import json
+import os
+import platform
+import random
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+
+BOT_USER_ID = 1
+INTERACTION_DEADLINE = 3.0
+USER_ID_BASE = 100000000000000000
+
+# --- Firebase Realtime Database の代わり ---
+# パスごとの JSON の木をメモリ上に持つ。値は JSON を通して保存するため、保存できない値は実物と同じく失敗する。
+# 書き込みは executor のスレッドから呼ばれるためロックで守り、latency 秒の通信時間を真似る
+class FakeDatabase:
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.root = {}
+        self.ops = Counter()
+        self._lock = threading.Lock()
+
+    def reference(self, path=""):
+        return FakeReference(self, [part for part in path.split("/") if part])
+
+    def _access(self, op):
+        if self.latency:
+            time.sleep(self.latency)
+        with self._lock:
+            self.ops[op] += 1
+
+    def _get(self, parts):
+        node = self.root
+        for part in parts:
+            if not isinstance(node, dict) or part not in node:
+                return None
+            node = node[part]
+        return copy.deepcopy(node)
+
+    def _set(self, parts, value):
+        value = json.loads(json.dumps(value))
+        if not parts:
+            self.root = value if isinstance(value, dict) else {}
+            return
+        path, node = [], self.root
+        for part in parts[:-1]:
+            child = node.get(part)
+            if not isinstance(child, dict):
+                if value is None:
+                    return
+                child = node[part] = {}
+            path.append((node, part))
+            node = child
+        if value is None or value == {}:
+            node.pop(parts[-1], None)
+            # 空になった親のノードは実物と同じく消える
+            for parent, part in reversed(path):
+                if parent[part]:
+                    break
+                del parent[part]
+        else:
+            node[parts[-1]] = value
+
+class FakeReference:
+    def __init__(self, db, parts, limit_last=None):
+        self.db = db
+        self.parts = parts
+        self.limit_last = limit_last
+
+    def child(self, path):
+        return FakeReference(self.db, self.parts + [part for part in path.split("/") if part])
+
+    # order_by_key().limit_to_last(n) の組み合わせだけに対応する
+    def order_by_key(self):
+        return self
+
+    def limit_to_last(self, limit):
+        return FakeReference(self.db, self.parts, limit)
+
+    def get(self):
+        self.db._access('get')
+        with self.db._lock:
+            value = self.db._get(self.parts)
+        if self.limit_last is not None and isinstance(value, dict):
+            value = {key: value[key] for key in sorted(value)[-self.limit_last:]}
+        return value
+
+    def set(self, value):
+        self.db._access('set')
+        with self.db._lock:
+            self.db._set(self.parts, value)
+
+    def update(self, changes):
+        self.db._access('update')
+        with self.db._lock:
+            for key, value in changes.items():
+                self.db._set(self.parts + [part for part in key.split("/") if part], value)
+
+    def delete(self):
+        self.set(None)
+
+# --- Discord の代わり ---
+# コマンド処理が使う属性・メソッドだけを持つ。送信や問い合わせは latency 秒の通信時間を真似る
+class FakeUser:
+    def __init__(self, id, name, guild=None, bot=False):
+        self.id = id
+        self.name = name
+        self.display_name = name
+        self.global_name = None
+        self.guild = guild
+        self.bot = bot
+        self.mention = f"<@{id}>"
+
+class FakeMessage:
+    _ids = itertools.count(1)
+
+    def __init__(self, channel, content=None, id=None, **kwargs):
+        self.id = id if id is not None else next(self._ids)
+        self.channel = channel
+        self.content = content
+        self.kwargs = kwargs
+        self.reactions = []
+        self.attachments = []
+
+    async def add_reaction(self, emoji):
+        await asyncio.sleep(self.channel.latency)
+
+class FakeChannel:
+    def __init__(self, id, guild, latency):
+        self.id = id
+        self.guild = guild
+        self.latency = latency
+        self.messages = {}
+        self.sent = 0
+
+    async def send(self, content=None, **kwargs):
+        await asyncio.sleep(self.latency)
+        message = FakeMessage(self, content, **kwargs)
+        self.messages[message.id] = message
+        self.sent += 1
+        return message
+
+    async def fetch_message(self, message_id):
+        await asyncio.sleep(self.latency)
+        return self.messages.get(message_id) or FakeMessage(self, id=message_id)
+
+# MEMBER_CACHE_POLICY=participants の状態 (メンバー一覧はキャッシュせず、query_members で問い合わせる) を真似る
+class FakeGuild:
+    def __init__(self, id, user_count, latency):
+        self.id = id
+        self.latency = latency
+        self.users = {USER_ID_BASE + id * 10000 + i: None for i in range(user_count)}
+        for user_id in self.users:
+            self.users[user_id] = FakeUser(user_id, f"user{user_id % 10000}", self)
+        self.members = []
+        self.chunked = False
+        self.channel = FakeChannel(id * 10 + 1, self, latency)
+        self.recruit_message_id = 0
+
+    def user(self, index):
+        return self.users[USER_ID_BASE + self.id * 10000 + index]
+
+    def get_member(self, user_id):
+        return self.users.get(user_id)
+
+    def get_channel_or_thread(self, channel_id):
+        return self.channel if channel_id == self.channel.id else None
+
+    async def query_members(self, query=None, *, limit=5, user_ids=None, presences=False, cache=True):
+        await asyncio.sleep(self.latency)
+        return [self.users[user_id] for user_id in user_ids or () if user_id in self.users][:limit]
+
+    async def chunk(self):
+        self.members = list(self.users.values())
+        self.chunked = True
+
+class FakeResponse:
+    def __init__(self, interaction):
+        self.interaction = interaction
+        self._done = False
+        # 最初の応答が Discord に届いた時刻
+        self.responded_at = None
+
+    def is_done(self):
+        return self._done
+
+    async def _respond(self):
+        # 実物と同じく、1つのインタラクションに2回応答するとエラーにする
+        if self._done:
+            raise RuntimeError("このインタラクションには既に応答しています")
+        self._done = True
+        await asyncio.sleep(self.interaction.channel.latency)
+        self.responded_at = time.perf_counter()
+
+    async def send_message(self, content=None, **kwargs):
+        await self._respond()
+
+    async def defer(self, **kwargs):
+        await self._respond()
+
+class FakeFollowup:
+    def __init__(self, interaction):
+        self.interaction = interaction
+
+    async def send(self, content=None, **kwargs):
+        if not self.interaction.response.is_done():
+            raise RuntimeError("応答の前にフォローアップは送れません")
+        await asyncio.sleep(self.interaction.channel.latency)
+
+class FakeInteraction:
+    def __init__(self, guild, user):
+        self.guild = guild
+        self.guild_id = guild.id
+        self.channel = guild.channel
+        self.channel_id = guild.channel.id
+        self.user = user
+        self.extras = {}
+        self.command = None
+        self.response = FakeResponse(self)
+        self.followup = FakeFollowup(self)
+        self.created_at = time.perf_counter()
+
+    async def delete_original_response(self):
+        if not self.response.is_done():
+            raise RuntimeError("応答の前に元の応答は削除できません")
+        await asyncio.sleep(self.channel.latency)
+
+class FakeContext:
+    def __init__(self, guild, author):
+        self.guild = guild
+        self.channel = guild.channel
+        self.author = author
+        self.message = FakeMessage(guild.channel)
+
+    async def send(self, content=None, **kwargs):
+        return await self.channel.send(content, **kwargs)
+
+class FakeReactionPayload:
+    def __init__(self, guild, user, emoji, message_id):
+        self.guild_id = guild.id
+        self.channel_id = guild.channel.id
+        self.message_id = message_id
+        self.user_id = user.id
+        self.member = user
+        self.emoji = emoji
+
+# --- イベント列 ---
+# {"at": 開始時刻 (秒), "guild": ギルド番号, "op": 種類, "user": ギルド内のユーザー番号, "emoji": リアクション}
+# スラッシュコマンドの操作は、応答期限を調べるためにインタラクションを返す
+async def op_recruit(teambot, guild, user, event):
+    interaction = FakeInteraction(guild, user)
+    await teambot.recruit.callback(interaction)
+    state = await teambot.get_state(guild)
+    guild.recruit_message_id = state.recruit_messages.get(str(guild.channel.id), 0)
+    return interaction
+
+async def op_react_add(teambot, guild, user, event):
+    await teambot.on_raw_reaction_add(FakeReactionPayload(guild, user, event.get('emoji', "👍"), guild.recruit_message_id))
+
+async def op_react_remove(teambot, guild, user, event):
+    await teambot.on_raw_reaction_remove(FakeReactionPayload(guild, user, event.get('emoji', "👍"),
+                                                         guild.recruit_message_id))
+
+async def op_join(teambot, guild, user, event):
+    await teambot.join(FakeContext(guild, user), user.mention)
+
+async def op_slash_join(teambot, guild, user, event):
+    interaction = FakeInteraction(guild, user)
+    await teambot.slash_join.callback(interaction, user.mention)
+    return interaction
+
+async def op_leave(teambot, guild, user, event):
+    await teambot.leave(FakeContext(guild, user), user.mention)
+
+async def op_make_teams(teambot, guild, user, event):
+    await teambot.make_teams_cmd(FakeContext(guild, user))
+
+async def op_slash_make_teams(teambot, guild, user, event):
+    interaction = FakeInteraction(guild, user)
+    await teambot.slash_make_teams.callback(interaction)
+    return interaction
+
+async def op_reroll(teambot, guild, user, event):
+    await teambot.reroll_cmd(FakeContext(guild, user))
+
+async def op_reset_join(teambot, guild, user, event):
+    interaction = FakeInteraction(guild, user)
+    await teambot.reset_join.callback(interaction)
+    return interaction
+
+async def op_list_members(teambot, guild, user, event):
+    interaction = FakeInteraction(guild, user)
+    await teambot.list_members.callback(interaction)
+    return interaction
+
+async def op_list_joiners(teambot, guild, user, event):
+    interaction = FakeInteraction(guild, user)
+    await teambot.list_joiners.callback(interaction)
+    return interaction
+
+OPS = {
+    'recruit': op_recruit,
+    'react_add': op_react_add,
+    'react_remove': op_react_remove,
+    'join': op_join,
+    'slash_join': op_slash_join,
+    'leave': op_leave,
+    'make_teams': op_make_teams,
+    'slash_make_teams': op_slash_make_teams,
+    'reroll': op_reroll,
+    'list_joiners': op_list_joiners,
+    'list_members': op_list_members,
+    'reset_join': op_reset_join,
+}
+
+# 1回の募集の流れ: 募集 → 10人の参加 (途中で抜ける人を含む) → チーム分け → 引き直し・一覧表示
+def session_events(rng, guild_index, user_count):
+    players = rng.sample(range(user_count), 10)
+    events = [{'op': 'recruit', 'user': players[0]}]
+    for player in players:
+        op = rng.choice(('react_add', 'join', 'slash_join'))
+        events.append({'op': op, 'user': player, **({'emoji': "👍"} if op == 'react_add' else {})})
+    if rng.random() < 0.3:
+        extra = rng.choice([i for i in range(user_count) if i not in players])
+        events.append({'op': 'react_add', 'user': extra, 'emoji': "👍"})
+        events.append({'op': rng.choice(('react_remove', 'leave')), 'user': extra, 'emoji': "👍"})
+    roll = rng.choice(('react_add', 'make_teams', 'slash_make_teams'))
+    events.append({'op': roll, 'user': players[0], **({'emoji': "✅"} if roll == 'react_add' else {})})
+    events += [{'op': 'reroll', 'user': players[0]}] * rng.randint(0, 2)
+    if rng.random() < 0.5:
+        events.append({'op': 'list_joiners', 'user': players[1]})
+    if rng.random() < 0.2:
+        events.append({'op': 'list_members', 'user': players[1]})
+    if rng.random() < 0.3:
+        events.append({'op': 'reset_join', 'user': players[0]})
+    for event in events:
+        event['guild'] = guild_index
+    return events
+
+# ギルドごとの流れを順序を保ったまま混ぜ合わせ、rate 件/秒のポアソン到着で時刻を割り当てる
+def generate_events(count, guild_count, user_count, rate, rng):
+    queues = [[] for _ in range(guild_count)]
+    events, at = [], 0.0
+    while len(events) < count:
+        g = rng.randrange(guild_count)
+        if not queues[g]:
+            queues[g] = session_events(rng, g, user_count)
+        event = queues[g].pop(0)
+        at += rng.expovariate(rate)
+        events.append({'at': round(at, 6), **event})
+    return events
+
+# --- 計測 ---
+def percentiles(samples):
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+
+    def at(q):
+        return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+    return {
+        'count': len(samples),
+        'p50_ms': at(0.50) * 1000,
+        'p95_ms': at(0.95) * 1000,
+        'p99_ms': at(0.99) * 1000,
+        'max_ms': samples[-1] * 1000,
+    }
+
+# interval 秒ごとに起き、予定より遅れた時間をイベントループが止まっていた時間として記録する
+async def monitor_loop_stalls(interval, lags, stop):
+    while not stop.is_set():
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, time.perf_counter() - started - interval))
+
+def setup_bot(args):
+    # main は import 時に環境変数を読むため、先に設定しておく
+    os.environ.setdefault("MEMBER_CACHE_POLICY", "participants")
+    os.environ["SEARCH_EXECUTOR"] = args.search_executor
+    if args.debounce is not None:
+        os.environ["ROLL_DEBOUNCE"] = str(args.debounce)
+    import main as teambot
+    from outbox import Outbox
+    from storage import FirebaseStorage
+
+    db = FakeDatabase(args.db_latency)
+    teambot.init_storage(FirebaseStorage(db=db))
+    if not args.pace_sends:
+        # 送信の間隔調整 (5通/5秒) を外し、コマンド処理そのものの負荷を見る
+        teambot.outbox = Outbox(rate=10 ** 9)
+    # ログインしていない Bot でも、リアクションの処理がギルドと自分のユーザーを引けるようにする
+    guilds = {g: FakeGuild(g, args.members, args.discord_latency) for g in range(1, args.guilds + 1)}
+    teambot.bot.get_guild = guilds.get
+    teambot.bot._connection.user = FakeUser(BOT_USER_ID, "teambot", bot=True)
+    for guild in guilds.values():
+        # 登録メンバーは全員、パワーは 0〜100 の一様分布
+        rng = random.Random(args.seed + guild.id)
+        db.reference(f"guilds/{guild.id}/members").set(
+            {str(user_id): rng.randint(0, 100) for user_id in guild.users})
+    db.ops.clear()
+    return teambot, db, guilds
+
+async def replay(teambot, guilds, events, stall_interval, warmup=True):
+    latencies, service_times, first_responses = {}, {}, {}
+    errors = Counter()
+    error_samples = {}
+    if warmup:
+        # プロセスプールのワーカーの起動 (初回だけかかる時間) は計測に含めない
+        await asyncio.gather(*(teambot.search_pool.run(sum, ()) for _ in range(teambot.search_pool.workers or 1)))
+    lags, stop = [], asyncio.Event()
+    monitor = asyncio.create_task(monitor_loop_stalls(stall_interval, lags, stop))
+
+    async def run(event, start):
+        guild = guilds[event['guild'] + 1]
+        user = guild.user(event['user'])
+        await asyncio.sleep(max(0.0, start + event['at'] - time.perf_counter()))
+        begun = time.perf_counter()
+        interaction = None
+        try:
+            interaction = await OPS[event['op']](teambot, guild, user, event)
+        except Exception:
+            errors[event['op']] += 1
+            error_samples.setdefault(event['op'], traceback.format_exc())
+        finished = time.perf_counter()
+        if interaction is not None:
+            responded_at = interaction.response.responded_at
+            if responded_at is None:
+                errors[event['op']] += 1
+                error_samples.setdefault(event['op'], "インタラクションに応答しませんでした")
+            else:
+                first_response = responded_at - interaction.created_at
+                first_responses.setdefault(event['op'], []).append(first_response)
+                if first_response > INTERACTION_DEADLINE:
+                    errors[event['op']] += 1
+                    error_samples.setdefault(
+                        event['op'], f"最初の応答が期限 ({INTERACTION_DEADLINE}秒) を過ぎました: {first_response:.2f}秒")
+        latencies.setdefault(event['op'], []).append(finished - (start + event['at']))
+        service_times.setdefault(event['op'], []).append(finished - begun)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(run(event, start) for event in events))
+    elapsed = time.perf_counter() - start
+    flush_started = time.perf_counter()
+    await teambot.writer.flush()
+    flush_time = time.perf_counter() - flush_started
+    stop.set()
+    await monitor
+    return {
+        'elapsed_s': elapsed,
+        'throughput_per_s': len(events) / elapsed if elapsed else None,
+        'latency': {op: percentiles(samples) for op, samples in sorted(latencies.items())},
+        'latency_all': percentiles([s for samples in latencies.values() for s in samples]),
+        'service_time': {op: percentiles(samples) for op, samples in sorted(service_times.items())},
+        'first_response': {op: percentiles(samples) for op, samples in sorted(first_responses.items())},
+        'loop_stall': {
+            'interval_ms': stall_interval * 1000,
+            'total_ms': sum(lags) * 1000,
+            'max_ms': max(lags, default=0.0) * 1000,
+            'p99_ms': percentiles(lags).get('p99_ms', 0.0),
+        },
+        'final_flush_s': flush_time,
+        'errors': dict(errors),
+        'error_samples': error_samples,
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="コマンド処理の負荷試験 (Discord / Firebase の偽物を使ったリプレイ)")
+    parser.add_argument("--guilds", type=int, default=20)
+    parser.add_argument("--members", type=int, default=40, help="ギルドごとの登録メンバー数 (10以上)")
+    parser.add_argument("--events", type=int, default=5000, help="ランダムに作るイベント数")
+    parser.add_argument("--rate", type=float, default=500.0, help="1秒あたりのイベント数")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--script", help="再生するイベント列 (JSON Lines)。指定時はランダムに作らない")
+    parser.add_argument("--save-script", help="作ったイベント列の保存先 (JSON Lines)")
+    parser.add_argument("--db-latency", type=float, default=0.02, help="Firebase の1回の読み書きにかかる秒数")
+    parser.add_argument("--discord-latency", type=float, default=0.05, help="Discord API の1回の呼び出しにかかる秒数")
+    parser.add_argument("--search-executor", default=os.environ.get("SEARCH_EXECUTOR", "process"),
+                        choices=("process", "thread", "inline"))
+    parser.add_argument("--debounce", type=float, help="チーム分けの要求をまとめる待ち時間 (省略時は ROLL_DEBOUNCE)")
+    parser.add_argument("--pace-sends", action="store_true", help="チャンネルごとの送信の間隔調整を有効にする")
+    parser.add_argument("--no-warmup", action="store_true",
+                        help="計測前に探索のプールを起動しない (初回の起動時間も計測に含める)")
+    parser.add_argument("--stall-interval", type=float, default=0.005, help="イベントループの停止を調べる間隔 (秒)")
+    parser.add_argument("--output", help="レポートの出力先 (省略時は標準出力)")
+    args = parser.parse_args(argv)
+    if args.members < 10:
+        parser.error("--members は10以上にしてください")
+
+    if args.script:
+        with open(args.script, encoding="utf-8") as f:
+            events = [json.loads(line) for line in f if line.strip()]
+        args.guilds = max(args.guilds, max((event['guild'] for event in events), default=0) + 1)
+        args.members = max(args.members, max((event['user'] for event in events), default=0) + 1)
+    else:
+        events = generate_events(args.events, args.guilds, args.members, args.rate, random.Random(args.seed))
+    if args.save_script:
+        with open(args.save_script, "w", encoding="utf-8") as f:
+            for event in events:
+                f.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    teambot, db, guilds = setup_bot(args)
+
+    async def run():
+        try:
+            return await replay(teambot, guilds, events, args.stall_interval, warmup=not args.no_warmup)
+        finally:
+            teambot.search_pool.shutdown()
+            teambot.storage.close()
+
+    result = asyncio.run(run())
+    report = {
+        'timestamp': time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'params': {key: value for key, value in vars(args).items() if key not in ('output', 'save_script')},
+        'events': len(events),
+        'ops': dict(Counter(event['op'] for event in events)),
+        **result,
+        'storage_ops': dict(db.ops),
+        'messages_sent': sum(guild.channel.sent for guild in guilds.values()),
+    }
+    text = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    return 1 if result['errors'] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,14 +1,68 @@
+import time
+started_at = time.perf_counter()  # 起動時間の計測開始 (discord などの import も含める)
 import discord
-from discord.ext import commands
+from discord import app_commands
+from discord.ext import commands, tasks
+import asyncio
+import hashlib
+import hmac
+import inspect
+import io
 import itertools
+import json
+import math
 import os
-import random
 import threading
-from flask import Flask
-import base64
-import firebase_admin
-from firebase_admin import credentials, db
+from flask import Flask, Response, abort, jsonify, request
 from collections import Counter
+from functools import partial
+from batch_api import roster_result
+from guild_state import GuildState, GuildStateCache, HistoryStats
+from metrics import Instrumented, Registry
+from name_resolver import DisplayNameResolver
+from outbox import EMBED_FIELD_LIMIT, Outbox, paginate, respond_embeds, respond_pages
+from persistence import WriteBehindWriter
+from roll_coordinator import RollCoordinator
+from roster_io import MAX_ROSTER_FILE_SIZE, ROSTER_FORMATS, read_roster, roster_format, write_roster
+from storage import create_storage, new_history_keys, HISTORY_WINDOW
+from search_pool import SearchPool
+from team_engine import LANES, TeamConstraints, decide_swap, make_lobbies, pick_teams, search_teams, team_candidates
+
+# --- メトリクス (/metrics で Prometheus テキスト形式で公開) ---
+registry = Registry()
+command_duration = registry.histogram(
+    "teambot_command_duration_seconds", "コマンドの処理時間", ("kind", "command", "status"))
+storage_duration = registry.histogram(
+    "teambot_storage_duration_seconds", "保存先の読み書きの所要時間", ("operation",))
+storage_errors = registry.counter(
+    "teambot_storage_errors_total", "保存先の読み書きの失敗回数", ("operation",))
+search_duration = registry.histogram(
+    "teambot_team_search_duration_seconds", "チーム分けの探索時間", ("mode",))
+rolls_coalesced = registry.counter(
+    "teambot_rolls_coalesced_total", "実行中・待機中のチーム分けに相乗りした要求の数")
+search_candidates = registry.histogram(
+    "teambot_team_search_candidates", "チーム分けで評価した候補数", ("mode",),
+    buckets=(126, 1000, 10000, 100000, 1000000))
+writes_failed = registry.counter(
+    "teambot_writes_failed_total", "遅延書き込みの失敗回数 (dropped=true は再送せずに破棄したもの)", ("node", "dropped"))
+search_budget_exhausted = registry.counter(
+    "teambot_team_search_budget_exhausted_total", "制限時間内に全候補を評価できなかったチーム分けの数", ("mode",))
+registry.gauge(
+    "teambot_gateway_latency_seconds", "Discord ゲートウェイのレイテンシ (シャードごと)",
+    lambda: {(str(shard_id),): latency for shard_id, latency in bot.latencies}, ("shard",))
+registry.gauge("teambot_loaded_guilds", "メモリに読み込まれているギルド数", lambda: len(guild_states.states))
+registry.gauge("teambot_members", "読み込み済みギルドの登録メンバー数の合計", lambda: loaded_state_size('members'))
+registry.gauge("teambot_participants", "読み込み済みギルドの参加者数の合計", lambda: loaded_state_size('participants'))
+registry.gauge("teambot_history_entries", "読み込み済みギルドの履歴件数の合計", lambda: loaded_state_size('history'))
+
+def loaded_state_size(attr):
+    return sum(len(getattr(state, attr)) for state in list(guild_states.states.values()))
+
+# --- 探索の実行先 (SEARCH_EXECUTOR=process / thread / inline) ---
+# 探索はイベントループの外で行い、SEARCH_TIME_BUDGET 秒で打ち切ってそれまでの最良の結果を使う
+search_pool = SearchPool(os.environ.get("SEARCH_EXECUTOR", "process"),
+                         int(os.environ.get("SEARCH_WORKERS", 2)))
+SEARCH_TIME_BUDGET = float(os.environ.get("SEARCH_TIME_BUDGET", 0.3))
 
 # --- Flaskによるスリープ対策サーバー ---
 app = Flask(__name__)
@@ -17,65 +71,155 @@ app = Flask(__name__)
 def home():
     return "Bot is running!"
 
+@app.route('/metrics')
+def metrics():
+    return Response(registry.render(), mimetype="text/plain; version=0.0.4")
+
+# --- チーム分けの一括 API (形式は batch_api.py を参照) ---
+# BATCH_API_TOKEN を設定したときだけ有効になり、Authorization: Bearer <トークン> を要求する。
+# ロスターは探索のプールで並列に処理する (1件あたりの制限時間は SEARCH_TIME_BUDGET まで)
+BATCH_API_TOKEN = os.environ.get("BATCH_API_TOKEN")
+BATCH_MAX_ROSTERS = int(os.environ.get("BATCH_MAX_ROSTERS", 100))
+
+@app.route('/api/make_teams', methods=['POST'])
+def api_make_teams():
+    if not BATCH_API_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {BATCH_API_TOKEN}"):
+        return jsonify(error="認証に失敗しました"), 401
+    body = request.get_json(silent=True)
+    rosters = body.get('rosters') if isinstance(body, dict) else None
+    if not isinstance(rosters, list):
+        return jsonify(error="rosters をリストで指定してください"), 400
+    if len(rosters) > BATCH_MAX_ROSTERS:
+        return jsonify(error=f"1回のリクエストで指定できるロスターは{BATCH_MAX_ROSTERS}件までです"), 413
+    try:
+        time_budget = float(body.get('time_budget', SEARCH_TIME_BUDGET))
+    except (TypeError, ValueError):
+        return jsonify(error="time_budget は数値で指定してください"), 400
+    if not (math.isfinite(time_budget) and time_budget > 0):
+        return jsonify(error="time_budget は正の数で指定してください"), 400
+    time_budget = min(time_budget, SEARCH_TIME_BUDGET)
+    with search_duration.time(mode="batch_api"):
+        results = search_pool.map(roster_result, rosters, itertools.repeat(time_budget),
+                                  chunksize=max(1, len(rosters) // (search_pool.workers * 4)))
+    for result in results:
+        if 'explored' in result:
+            search_candidates.observe(result['explored'], mode="batch_api")
+    return jsonify(results=results)
+
 def run_flask():
     app.run(host="0.0.0.0", port=8080)
 
-threading.Thread(target=run_flask).start()
+# --- 保存先 (STORAGE_BACKEND=firebase / sqlite) ---
+# import 時には何も起動しない。サーバーの起動と保存先への接続は main() で行う
+storage = None
+
+def init_storage(backend=None):
+    global storage
+    storage = Instrumented(backend or create_storage(), storage_duration, storage_errors)
+    return storage
+
+# --- 書き込みはイベントループ外で遅延・集約して実行 (終了時に未送信分を送る) ---
+# ノード全体を書き直さず、変更のあったキーだけをまとめて保存先に送る
+def report_write_error(key, error, dropped):
+    node, guild_id = key
+    writes_failed.inc(node=node, dropped=str(dropped).lower())
+    if dropped:
+        print(f"{node} の保存に失敗したため変更を破棄しました (guild={guild_id}): {error!r}")
+
+writer = WriteBehindWriter(max_attempts=int(os.environ.get("WRITE_MAX_ATTEMPTS", 5)), on_error=report_write_error)
+
+def update_members(guild_id, changes):
+    # changes は {名前: パワー}。値が None のメンバーは削除される
+    writer.schedule_update(('members', guild_id), partial(storage.update_members, guild_id), changes)
 
-# --- Firebase認証情報の復号とファイル作成 ---
-firebase_cred_base64 = os.environ.get("FIREBASE_CRED_BASE64")
-firebase_cred_path = "serviceAccountKey.json"
+def get_members(guild_id):
+    return storage.get_members(guild_id)
 
-if not firebase_cred_base64:
-    raise ValueError("環境変数 FIREBASE_CRED_BASE64 が設定されていません")
+# 履歴は追記のみ。キーは時刻順の連番で、古い履歴も保存に残る。追記したキーを返す
+def append_history(guild_id, entries):
+    keys = new_history_keys(len(entries))
+    changes = dict(zip(keys, ([sorted(t1), sorted(t2)] for t1, t2 in entries)))
+    writer.schedule_update(('history', guild_id), partial(storage.append_history, guild_id), changes)
+    return keys
 
-with open(firebase_cred_path, "wb") as f:
-    f.write(base64.b64decode(firebase_cred_base64))
+def get_history(guild_id, limit=HISTORY_WINDOW):
+    return storage.get_history(guild_id, limit)
 
-firebase_db_url = os.environ.get("FIREBASE_DB_URL")
-if not firebase_db_url:
-    raise ValueError("環境変数 FIREBASE_DB_URL が設定されていません")
+def update_settings(guild_id, changes):
+    writer.schedule_update(('settings', guild_id), partial(storage.update_settings, guild_id), changes)
 
-# --- Firebase初期化 ---
-cred = credentials.Certificate(firebase_cred_path)
-firebase_admin.initialize_app(cred, {'databaseURL': firebase_db_url})
+def load_settings(guild_id):
+    return storage.get_settings(guild_id)
 
-ref = db.reference('members')
-history_ref = db.reference('history')
-settings_ref = db.reference('settings')
+def update_roles(guild_id, changes):
+    writer.schedule_update(('roles', guild_id), partial(storage.update_roles, guild_id), changes)
 
-def save_members(members_dict):
-    ref.set(members_dict)
+def update_stats(guild_id, changes):
+    writer.schedule_update(('stats', guild_id), partial(storage.update_stats, guild_id), changes)
 
-def get_members():
-    data = ref.get()
-    return data if data else {}
+# executor 上で呼ばれる。ギルドの状態を読み込む
+def load_guild_state(guild_id):
+    members, history, settings, stats, roles = storage.load_guild(guild_id)
+    if history and not stats['matches']:
+        # 累計がまだ無いギルドは、保存されている全履歴から一度だけ作り直す
+        history_stats = HistoryStats()
+        storage.update_stats(guild_id, history_stats.add(get_history(guild_id, limit=None)))
+    else:
+        history_stats = HistoryStats(stats['matches'], stats['pairs'])
+    return GuildState(guild_id, members, history, settings, history_stats, roles)
+
+# 履歴をメモリ上の直近の履歴・累計に反映し、保存先へ追記する
+def record_history(state, entries):
+    update_stats(state.guild_id, state.add_history(entries))
+    return append_history(state.guild_id, entries)
+
+# 直前の履歴 (保存先のキー key) を引き直した結果で置き換える
+def replace_last_history(state, key, entry):
+    update_stats(state.guild_id, state.replace_last_history(entry))
+    t1, t2 = entry
+    writer.schedule_update(('history', state.guild_id), partial(storage.append_history, state.guild_id),
+                           {key: [sorted(t1), sorted(t2)]})
 
-def save_history(history_list):
-    history_ref.set(history_list)
+guild_states = GuildStateCache(load_guild_state, idle_timeout=int(os.environ.get("GUILD_IDLE_TIMEOUT", 3600)))
 
-def get_history():
-    data = history_ref.get()
-    return data if data else []
+async def get_state(guild):
+    state = await guild_states.get(guild.id)
+    if not state.names_ready:
+        state.names_ready = True
+        prepare_display_names(guild)
+    if MEMBER_CACHE_POLICY == "participants":
+        # 未取得・期限切れの参加者の表示名だけを問い合わせる (期限内なら問い合わせない)
+        await name_resolver.prefetch(guild, state.participants)
+    return state
 
-def save_settings(settings_dict):
-    settings_ref.set(settings_dict)
+# メンバーのキャッシュ方針 (MEMBER_CACHE_POLICY)
+#   full: 起動時に全ギルドのメンバー一覧を取得してすべてキャッシュする
+#   lazy: 起動時には取得せず、ギルドで初めてコマンドが使われたときに取得する
+#   participants: メンバー一覧はキャッシュせず、参加者の表示名だけを問い合わせて持つ。
+#                 それ以外の名前は表示するときに問い合わせる (fetch_display_names)
+# participants ではメモリ使用量がギルドの人数ではなく、参加者と表示した名前の数に比例する。
+# ただしメンバーの更新・退出イベントが届かないため、表示名の変更は NAME_CACHE_TTL 秒 (既定 600) 以内の遅れで反映される
+MEMBER_CACHE_POLICIES = ("full", "lazy", "participants")
+MEMBER_CACHE_POLICY = os.environ.get("MEMBER_CACHE_POLICY", "participants")
 
-def load_settings():
-    return settings_ref.get() or {}
+def prepare_display_names(guild):
+    if MEMBER_CACHE_POLICY == "lazy" and not guild.chunked:
+        asyncio.create_task(guild.chunk())
 
-def check_participants_minimum(min_required=10):
-    current_count = len(participants)
+def check_participants_minimum(state, min_required=10):
+    current_count = len(state.participants)
     if current_count < min_required:
         return min_required - current_count
     return 0
 
-def validate_participant_count_message():
-    count = len(participants)
+def validate_participant_count_message(state):
+    count = len(state.participants)
     if count < 10:
         return f"参加者があと{10 - count}人必要です。"
     if count > 10:
-        return f"参加者が{count}人います。"
+        return f"参加者が{count}人います。(11人以上は make_lobbies / split_teams を使ってください)"
     return None
 
 intents = discord.Intents.default()
@@ -83,23 +227,95 @@ intents.message_content = True
 intents.reactions = True
 intents.members = True
 
-class TeamBot(commands.Bot):
+# --- スラッシュコマンドはサーバー内でのみ受け付ける ---
+class TeamTree(app_commands.CommandTree):
+    async def interaction_check(self, interaction: discord.Interaction) -> bool:
+        interaction.extras['started_at'] = time.perf_counter()
+        if interaction.guild is None:
+            await interaction.response.send_message("このコマンドはサーバー内で使用してください。")
+            return False
+        return True
+
+    async def on_error(self, interaction: discord.Interaction, error):
+        record_app_command_duration(interaction, "error")
+        await super().on_error(interaction, error)
+
+def record_app_command_duration(interaction, status):
+    started_at = interaction.extras.get('started_at')
+    if started_at is None or interaction.command is None:
+        return
+    command_duration.observe(time.perf_counter() - started_at,
+                             kind="slash", command=interaction.command.qualified_name, status=status)
+
+# 1プロセスで多数のギルドを扱えるよう自動シャーディングする (SHARD_COUNT 未指定時は Discord の推奨数)
+class TeamBot(commands.AutoShardedBot):
     def __init__(self):
-        super().__init__(command_prefix="!", intents=intents)
+        if MEMBER_CACHE_POLICY not in MEMBER_CACHE_POLICIES:
+            raise ValueError(f"MEMBER_CACHE_POLICY の値が不正です: {MEMBER_CACHE_POLICY}")
+        shard_count = os.environ.get("SHARD_COUNT")
+        if MEMBER_CACHE_POLICY == "participants":
+            member_cache_flags = discord.MemberCacheFlags.none()
+        else:
+            member_cache_flags = discord.MemberCacheFlags.from_intents(intents)
+        super().__init__(command_prefix="!", intents=intents, tree_cls=TeamTree,
+                         shard_count=int(shard_count) if shard_count else None,
+                         chunk_guilds_at_startup=MEMBER_CACHE_POLICY == "full",
+                         member_cache_flags=member_cache_flags)
+        self.startup_reported = False
 
     async def setup_hook(self):
+        await self.sync_commands_if_changed()
+        evict_idle_guilds.start()
+
+    # 全体への tree.sync() は遅くレート制限もあるため、コマンド定義のハッシュが前回の同期時と
+    # 変わっていなければ省略する (FORCE_COMMAND_SYNC=1 で常に同期)
+    async def sync_commands_if_changed(self):
+        payload = json.dumps([command.to_dict(self.tree) for command in self.tree.get_commands()],
+                             sort_keys=True, ensure_ascii=False)
+        digest = hashlib.sha256(payload.encode()).hexdigest()
+        key = f"command_hash_{self.application_id}"
+        loop = asyncio.get_running_loop()
+        if not os.environ.get("FORCE_COMMAND_SYNC") and await loop.run_in_executor(None, storage.get_meta, key) == digest:
+            print("スラッシュコマンドに変更がないため同期を省略しました")
+            return
         await self.tree.sync()
+        await loop.run_in_executor(None, storage.set_meta, key, digest)
+        print("スラッシュコマンドを同期しました")
+
+    async def close(self):
+        try:
+            await writer.close()
+        finally:
+            search_pool.shutdown()
+            storage.close()
+            await super().close()
 
 bot = TeamBot()
+name_resolver = DisplayNameResolver(ttl=float(os.environ.get("NAME_CACHE_TTL", 600)))
+
+@bot.check
+async def guild_only(ctx):
+    return ctx.guild is not None
+
+@bot.before_invoke
+async def start_command_timer(ctx):
+    ctx.started_at = time.perf_counter()
 
-members = get_members()
-participants = set()
-raw_history = get_history()
-history = [(frozenset(t[0]), frozenset(t[1])) for t in raw_history]
+@bot.after_invoke
+async def record_command_duration(ctx):
+    command_duration.observe(time.perf_counter() - ctx.started_at, kind="prefix",
+                             command=ctx.command.qualified_name, status="error" if ctx.command_failed else "ok")
 
-settings = load_settings()
-power_diff_tolerance = settings.get('power_diff_tolerance', 10)
-initial_power = settings.get('initial_power', 50)
+@bot.event
+async def on_app_command_completion(interaction, command):
+    record_app_command_duration(interaction, "ok")
+
+# 使われていないギルドの状態をメモリから破棄する (未送信の書き込みがあるギルドは残す)
+@tasks.loop(minutes=5)
+async def evict_idle_guilds():
+    busy = {key[1] for key in (*writer.pending, *writer.in_flight)}
+    for guild_id in guild_states.evict_idle(keep=lambda guild_id: guild_id in busy):
+        name_resolver.forget(guild_id)
 
 def extract_name(name_str):
     if name_str.startswith("<@") and name_str.endswith(">"):
@@ -107,90 +323,62 @@ def extract_name(name_str):
     return name_str
 
 def get_display_name(guild, name):
-    member = discord.utils.find(lambda m: m.name == name or str(m.id) == name, guild.members) if guild else None
-    if member:
-        return member.display_name
-    return name
-
-def normalize_pair(t1, t2):
-    t1_sorted = frozenset(sorted(t1))
-    t2_sorted = frozenset(sorted(t2))
-    return (t1_sorted, t2_sorted) if t1_sorted < t2_sorted else (t2_sorted, t1_sorted)
-
-def member_repeat_score(t1, t2):
-    score = 0
-    weights = [100, 10, 5, 2, 1]
-    current = normalize_pair(t1, t2)
-    for idx, past in enumerate(history[::-1]):
-        past_norm = normalize_pair(past[0], past[1])
-        weight = weights[idx] if idx < len(weights) else 1
-        if current[0] == past_norm[0] and current[1] == past_norm[1]:
-            score += weight * len(t1.intersection(past[0]))
-            score += weight * len(t2.intersection(past[1]))
-        elif current[0] == past_norm[1] and current[1] == past_norm[0]:
-            score += weight * len(t1.intersection(past[1]))
-            score += weight * len(t2.intersection(past[0]))
-    return score
-
-def count_overlap(set1, set2):
-    return len(set1.intersection(set2))
-
-def decide_swap(team1, team2, prev_team1, prev_team2):
-    overlap_normal = count_overlap(team1, prev_team1) + count_overlap(team2, prev_team2)
-    overlap_swapped = count_overlap(team1, prev_team2) + count_overlap(team2, prev_team1)
-    if overlap_swapped < overlap_normal:
-        return team2, team1
-    else:
-        return team1, team2
+    return name_resolver.resolve(guild, name)
 
-async def handle_participation_add(guild, name, channel):
-    global participants, members, initial_power
-    key_name = extract_name(name)
-    notice = ""
-    if key_name not in members:
-        members[key_name] = initial_power
-        save_members(members)
-        notice = f"(未登録のためパワー{initial_power}で登録しました)"
-    participants.add(key_name)
-    display_name = get_display_name(guild, key_name)
+def get_display_names(guild, names):
+    return name_resolver.resolve_many(guild, names)
 
-    if notice:
-        await channel.send(f"{display_name} が参加しました。\n{notice}")
-    else:
-        await channel.send(f"{display_name} が参加しました。")
+# 参加者以外の名前を表示するとき用。キャッシュに無い表示名を問い合わせてから引く
+async def fetch_display_names(guild, names):
+    names = list(names)
+    await name_resolver.prefetch(guild, names)
+    return get_display_names(guild, names)
+
+# 複数人の参加をまとめて処理し、1通分の返信の文面を返す (未登録の人の登録も1回の書き込みにまとめる)
+async def handle_participation_add(guild, names):
+    state = await get_state(guild)
+    key_names = list(dict.fromkeys(extract_name(name) for name in names))
+    await name_resolver.prefetch(guild, key_names)
+    registered = [n for n in key_names if n not in state.members]
+    for key_name in registered:
+        state.members[key_name] = state.initial_power
+    if registered:
+        update_members(guild.id, {n: state.initial_power for n in registered})
+    state.participants.update(key_names)
+    msg = f"参加しました: {', '.join(get_display_names(guild, key_names))}"
+    if registered:
+        msg += f"\n(未登録のためパワー{state.initial_power}で登録しました: {', '.join(get_display_names(guild, registered))})"
+    return msg
+
+# 登録を削除したメンバーのロール情報も削除する
+def remove_roles(state, names):
+    removed = [n for n in names if state.roles.pop(n, None) is not None]
+    if removed:
+        update_roles(state.guild_id, {n: None for n in removed})
+
+# --- 送信 ---
+# 1つのコマンドの出力は最小限の通数にまとめ、同じチャンネルへの複数通の送信は Outbox で間隔を空ける
+outbox = Outbox()
+
+async def send_text(channel, text):
+    await outbox.send_pages(channel, paginate(text.split("\n")))
 
 @bot.command(name="show_history")
 async def show_history(ctx):
+    state = await get_state(ctx.guild)
+    history = state.history
     if not history:
         await ctx.send("履歴がありません。")
         return
 
+    await name_resolver.prefetch(ctx.guild, {n for entry in history for team in entry for n in team})
     lines = []
-    for i, (team1, team2) in enumerate(history[-10:], start=1):
-        team1_names = ", ".join(sorted(get_display_name(ctx.guild, n) for n in team1))
-        team2_names = ", ".join(sorted(get_display_name(ctx.guild, n) for n in team2))
-        lines.append(f"第{i}回目:\n チーム1: {team1_names}\n チーム2: {team2_names}")
-
-    msg = "直近10回のチーム分け履歴:\n" + "\n\n".join(lines)
-    # Discord メッセージの長さ制限に配慮して分割送信（もし長すぎる場合）
-    MAX_LENGTH = 1900
-    if len(msg) <= MAX_LENGTH:
-        await ctx.send(f"``````")
-    else:
-        # 分割して送る処理
-        chunks = []
-        current_chunk = ""
-        for line in lines:
-            segment = f"{line}\n\n"
-            if len(current_chunk) + len(segment) > MAX_LENGTH:
-                chunks.append(current_chunk)
-                current_chunk = segment
-            else:
-                current_chunk += segment
-        if current_chunk:
-            chunks.append(current_chunk)
-        for chunk in chunks:
-            await ctx.send(f"``````")
+    for i, (team1, team2) in enumerate(history, start=1):
+        team1_names = ", ".join(sorted(get_display_names(ctx.guild, team1)))
+        team2_names = ", ".join(sorted(get_display_names(ctx.guild, team2)))
+        lines.append(f"第{i}回目:\n チーム1: {team1_names}\n チーム2: {team2_names}\n")
+    await outbox.send_pages(ctx.channel, paginate(lines, header=f"直近{len(history)}回のチーム分け履歴:\n",
+                                                  code_block=True))
 
 # 以下は元々あなたが示された完全版コードのコマンド部分とイベント等の一致した部分になります
 
@@ -200,6 +388,7 @@ async def add_member(ctx, *args):
         await ctx.send("引数は「メンバー名 パワー」のペアで指定してください。")
         return
     guild = ctx.guild
+    state = await get_state(guild)
     added = []
     failed = []
     for i in range(0, len(args), 2):
@@ -210,12 +399,14 @@ async def add_member(ctx, *args):
         except:
             failed.append(args[i] + " " + power_str)
             continue
-        members[name] = power
+        state.members[name] = power
         added.append(name)
-    save_members(members)
+    if added:
+        update_members(guild.id, {n: state.members[n] for n in added})
+        await name_resolver.prefetch(guild, added)
     msg = ""
     if added:
-        display_names = [get_display_name(guild, n) for n in added]
+        display_names = get_display_names(guild, added)
         msg += f"登録・更新しました: {', '.join(display_names)}\n"
     if failed:
         msg += f"無効な入力: {', '.join(failed)}"
@@ -224,22 +415,25 @@ async def add_member(ctx, *args):
 @bot.command(name="remove_member")
 async def remove_member(ctx, *args):
     guild = ctx.guild
+    state = await get_state(guild)
     removed = []
     not_found = []
     for name_raw in args:
         name = extract_name(name_raw)
-        if name in members:
-            del members[name]
+        if name in state.members:
+            del state.members[name]
             removed.append(name)
         else:
             not_found.append(name)
-    save_members(members)
+    if removed:
+        update_members(guild.id, {n: None for n in removed})
+        remove_roles(state, removed)
     msg = ""
     if removed:
-        display_names = [get_display_name(guild, n) for n in removed]
+        display_names = await fetch_display_names(guild, removed)
         msg += f"削除しました: {', '.join(display_names)}\n"
     if not_found:
-        display_names = [get_display_name(guild, n) for n in not_found]
+        display_names = await fetch_display_names(guild, not_found)
         msg += f"未登録メンバー: {', '.join(display_names)}"
     await ctx.send(msg or "名前を指定してください。")
 
@@ -248,282 +442,755 @@ async def join(ctx, *args):
     if not args:
         await ctx.send("名前を指定してください。")
         return
-    for name_raw in args:
-        await handle_participation_add(ctx.guild, name_raw, ctx.channel)
+    await send_text(ctx.channel, await handle_participation_add(ctx.guild, args))
 
 @bot.command(name="leave")
 async def leave(ctx, *args):
     guild = ctx.guild
+    state = await get_state(guild)
     removed = []
     not_found = []
     for name_raw in args:
         name = extract_name(name_raw)
-        if name in participants:
-            participants.remove(name)
+        if name in state.participants:
+            state.participants.remove(name)
             removed.append(name)
         else:
             not_found.append(name)
     msg = ""
     if removed:
-        display_names = [get_display_name(guild, n) for n in removed]
+        display_names = get_display_names(guild, removed)
         msg += f"参加をキャンセルしました: {', '.join(display_names)}\n"
     if not_found:
-        display_names = [get_display_name(guild, n) for n in not_found]
+        display_names = get_display_names(guild, not_found)
         msg += f"参加していません: {', '.join(display_names)}"
     await ctx.send(msg or "名前を指定してください。")
 
 @bot.command(name="set_initial_power")
 async def set_initial_power(ctx, power: int):
-    global initial_power, settings
     if power < 0:
         await ctx.send("初期パワーは0以上の整数で指定してください。")
         return
-    initial_power = power
-    settings['initial_power'] = initial_power
-    save_settings(settings)
-    await ctx.send(f"未登録メンバーの初期パワーを {initial_power} に設定し保存しました。")
+    state = await get_state(ctx.guild)
+    state.settings['initial_power'] = power
+    update_settings(ctx.guild.id, {'initial_power': power})
+    await ctx.send(f"未登録メンバーの初期パワーを {power} に設定し保存しました。")
 
 @bot.command(name="show_initial_power")
 async def show_initial_power(ctx):
-    global initial_power
-    await ctx.send(f"現在の初期パワーは {initial_power} です。")
+    state = await get_state(ctx.guild)
+    await ctx.send(f"現在の初期パワーは {state.initial_power} です。")
 
 @bot.tree.command(name="add_member", description="メンバーとパワーを登録します")
 async def slash_add_member(interaction: discord.Interaction, name: str, power: int):
-    global members
     guild = interaction.guild
+    state = await get_state(guild)
     key_name = extract_name(name)
-    members[key_name] = power
-    save_members(members)
+    state.members[key_name] = power
+    update_members(guild.id, {key_name: power})
+    await name_resolver.prefetch(guild, [key_name])
     display_name = get_display_name(guild, key_name)
     await interaction.response.send_message(f"{display_name} のパワーを {power} に設定・保存しました。")
 
 @bot.tree.command(name="remove_member", description="登録済みメンバーを削除します")
 async def slash_remove_member(interaction: discord.Interaction, name: str):
-    global members
     guild = interaction.guild
+    state = await get_state(guild)
     key_name = extract_name(name)
-    display_name = get_display_name(guild, key_name)
-    if key_name not in members:
+    display_name, = await fetch_display_names(guild, [key_name])
+    if key_name not in state.members:
         await interaction.response.send_message(f"{display_name} は登録されていません。")
         return
-    del members[key_name]
-    save_members(members)
+    del state.members[key_name]
+    update_members(guild.id, {key_name: None})
+    remove_roles(state, [key_name])
     await interaction.response.send_message(f"{display_name} を登録から削除しました。")
 
 @bot.tree.command(name="join", description="参加します")
 async def slash_join(interaction: discord.Interaction, name: str):
-    await handle_participation_add(interaction.guild, name, interaction.channel)
-    await interaction.response.defer()
+    await interaction.response.send_message(await handle_participation_add(interaction.guild, [name]))
 
 @bot.tree.command(name="leave", description="参加をキャンセルします")
 async def slash_leave(interaction: discord.Interaction, name: str):
-    global participants
     guild = interaction.guild
+    state = await get_state(guild)
     key_name = extract_name(name)
     display_name = get_display_name(guild, key_name)
-    if key_name not in participants:
+    if key_name not in state.participants:
         await interaction.response.send_message(f"{display_name} は参加していません。")
         return
-    participants.remove(key_name)
+    state.participants.remove(key_name)
     await interaction.response.send_message(f"{display_name} の参加をキャンセルしました。")
 
 @bot.tree.command(name="reset_join", description="参加者リストをリセットします")
 async def reset_join(interaction: discord.Interaction):
-    global participants
-    participants.clear()
+    state = await get_state(interaction.guild)
+    state.participants.clear()
     await interaction.response.send_message("参加者リストをリセットしました。")
 
 @bot.tree.command(name="list_members", description="登録済みメンバー一覧を表示します")
 async def list_members(interaction: discord.Interaction):
     guild = interaction.guild
-    sorted_members = sorted(members.items(), key=lambda item: item[1], reverse=True)
-    text = "登録メンバー:\n"
-    for name, power in sorted_members:
-        display_name = get_display_name(guild, name)
-        text += f"{display_name}: {power}\n"
-    await interaction.response.send_message(text)
+    state = await get_state(guild)
+    sorted_members = sorted(state.members.items(), key=lambda item: item[1], reverse=True)
+    if not sorted_members:
+        await interaction.response.send_message("登録メンバーはいません。")
+        return
+    # 登録メンバー全員の表示名の問い合わせは応答期限に間に合わないことがあるので、先に応答を保留する
+    await interaction.response.defer()
+    display_names = await fetch_display_names(guild, [name for name, _ in sorted_members])
+    lines = [f"{display_name}: {power}" for display_name, (name, power) in zip(display_names, sorted_members)]
+    await respond_pages(interaction, paginate(lines, header="登録メンバー:\n"))
 
 @bot.tree.command(name="list_joiners", description="現在の参加者一覧を表示します")
 async def list_joiners(interaction: discord.Interaction):
     guild = interaction.guild
-    sorted_list = sorted(participants, key=lambda p: members.get(p, 0), reverse=True)
+    state = await get_state(guild)
+    members = state.members
+    sorted_list = sorted(state.participants, key=lambda p: members.get(p, 0), reverse=True)
     if not sorted_list:
         await interaction.response.send_message("現在の参加者はいません。")
         return
-    lines = [f"{get_display_name(guild, p)}: {members.get(p, 0)}" for p in sorted_list]
-    await interaction.response.send_message("現在の参加者一覧:\n" + "\n".join(lines))
+    display_names = get_display_names(guild, sorted_list)
+    lines = [f"{d}: {members.get(p, 0)}" for d, p in zip(display_names, sorted_list)]
+    await respond_pages(interaction, paginate(lines, header="現在の参加者一覧:\n"))
 
 @bot.tree.command(name="set_tolerance", description="パワー差許容値を設定します")
 async def set_tolerance(interaction: discord.Interaction, value: int):
-    global power_diff_tolerance, settings
     if value < 0:
         await interaction.response.send_message("許容値は0以上の整数で指定してください。")
         return
-    power_diff_tolerance = value
-    settings['power_diff_tolerance'] = power_diff_tolerance
-    save_settings(settings)
-    await interaction.response.send_message(f"パワー差の許容値を {power_diff_tolerance} に設定・保存しました。")
+    state = await get_state(interaction.guild)
+    state.settings['power_diff_tolerance'] = value
+    update_settings(interaction.guild.id, {'power_diff_tolerance': value})
+    await interaction.response.send_message(f"パワー差の許容値を {value} に設定・保存しました。")
 
 @bot.tree.command(name="show_tolerance", description="現在のパワー差許容値を表示します")
 async def show_tolerance(interaction: discord.Interaction):
-    await interaction.response.send_message(f"現在のパワー差許容値は {power_diff_tolerance} です。")
+    state = await get_state(interaction.guild)
+    await interaction.response.send_message(f"現在のパワー差許容値は {state.power_diff_tolerance} です。")
+
+# --- ロール (レーン別パワーと希望レーン) ---
+LANE_ALIASES = {
+    'TOP': 'TOP', 'JG': 'JG', 'JUNGLE': 'JG', 'MID': 'MID',
+    'ADC': 'ADC', 'BOT': 'ADC', 'SUP': 'SUP', 'SUPPORT': 'SUP',
+}
+
+# 「TOP:60 MID:70 pref:MID,TOP」を ({レーン: パワー}, [希望レーン] または None) に変換する
+def parse_roles(args):
+    powers, prefs = {}, None
+    for arg in args:
+        key, sep, value = arg.partition(":")
+        key = key.upper()
+        if sep and key == 'PREF':
+            prefs = []
+            for lane in value.split(","):
+                if lane.strip().upper() not in LANE_ALIASES:
+                    raise ValueError(f"不明なレーンです: {lane}")
+                prefs.append(LANE_ALIASES[lane.strip().upper()])
+        elif sep and key in LANE_ALIASES:
+            try:
+                powers[LANE_ALIASES[key]] = int(value)
+            except ValueError:
+                raise ValueError(f"無効な入力: {arg}") from None
+        else:
+            raise ValueError(f"不明な指定です: {arg}")
+    return powers, prefs
+
+async def roles_message(guild, state, name):
+    role = state.roles.get(name) or {}
+    powers = role.get('powers') or {}
+    base = state.members.get(name)
+    lanes = " / ".join(f"{lane} {powers.get(lane, base if base is not None else '-')}" for lane in LANES)
+    prefs = ", ".join(role.get('prefs') or ()) or "なし"
+    display_name, = await fetch_display_names(guild, [name])
+    return f"{display_name}: {lanes} (希望: {prefs})"
+
+@bot.command(name="set_roles")
+async def set_roles(ctx, name, *args):
+    state = await get_state(ctx.guild)
+    key_name = extract_name(name)
+    if args == ("clear",):
+        remove_roles(state, [key_name])
+        display_name, = await fetch_display_names(ctx.guild, [key_name])
+        await ctx.send(f"{display_name} のロール情報を削除しました。")
+        return
+    try:
+        powers, prefs = parse_roles(args)
+    except ValueError as e:
+        await ctx.send(str(e))
+        return
+    if not powers and prefs is None:
+        await ctx.send("「TOP:60 MID:70 pref:MID,TOP」の形で指定してください。")
+        return
+    role = state.roles.get(key_name) or {}
+    role = {'powers': {**(role.get('powers') or {}), **powers}, 'prefs': role.get('prefs') or []}
+    if prefs is not None:
+        role['prefs'] = prefs
+    state.roles[key_name] = role
+    update_roles(ctx.guild.id, {key_name: role})
+    await ctx.send(await roles_message(ctx.guild, state, key_name))
+
+@bot.command(name="show_roles")
+async def show_roles(ctx, name):
+    state = await get_state(ctx.guild)
+    await ctx.send(await roles_message(ctx.guild, state, extract_name(name)))
+
+@bot.tree.command(name="set_role_mode", description="make_teams でレーン割り当てを含めてチーム分けするかを設定します")
+@app_commands.describe(enabled="レーン割り当てを行うか", off_role_penalty="希望レーン以外に割り当てたときに引くパワー")
+async def set_role_mode(interaction: discord.Interaction, enabled: bool, off_role_penalty: int = None):
+    if off_role_penalty is not None and off_role_penalty < 0:
+        await interaction.response.send_message("ペナルティは0以上の整数で指定してください。")
+        return
+    state = await get_state(interaction.guild)
+    changes = {'role_mode': enabled}
+    if off_role_penalty is not None:
+        changes['off_role_penalty'] = off_role_penalty
+    state.settings.update(changes)
+    update_settings(interaction.guild.id, changes)
+    status = "有効" if enabled else "無効"
+    await interaction.response.send_message(
+        f"ロールモードを{status}にしました。(希望レーン以外のペナルティ: {state.off_role_penalty})")
+
+# --- 登録メンバーの一括インポート・エクスポート (ファイルの形式は roster_io.py を参照) ---
+# 全行を検証してから、変更のあったメンバー・ロール情報だけをそれぞれ1回の書き込みで保存する
+IMPORT_REJECTED_SHOWN = 20
+
+async def run_import_members(guild, attachment):
+    if attachment is None:
+        return "CSV か JSON のファイルを添付してください。"
+    fmt = roster_format(attachment.filename)
+    if fmt is None:
+        return "ファイルの拡張子は .csv か .json にしてください。"
+    if attachment.size > MAX_ROSTER_FILE_SIZE:
+        return f"ファイルが大きすぎます。({MAX_ROSTER_FILE_SIZE // 1024}KB まで)"
+    state = await get_state(guild)
+    data = await attachment.read()
+    loop = asyncio.get_running_loop()
+    try:
+        rows, rejected = await loop.run_in_executor(None, read_roster, fmt, data, LANE_ALIASES, extract_name)
+    except ValueError as e:
+        return str(e)
+    added, updated, unchanged = [], [], 0
+    member_changes, role_changes = {}, {}
+    for name, (power, role) in rows.items():
+        power_changed = state.members.get(name) != power
+        role_changed = role is not None and state.roles.get(name) != role
+        if not power_changed and not role_changed:
+            unchanged += 1
+            continue
+        (updated if name in state.members else added).append(name)
+        if power_changed:
+            member_changes[name] = power
+        if role_changed:
+            role_changes[name] = role
+    state.members.update(member_changes)
+    state.roles.update(role_changes)
+    if member_changes:
+        update_members(guild.id, member_changes)
+    if role_changes:
+        update_roles(guild.id, role_changes)
+    msg = (f"インポートしました: 追加 {len(added)}人 / 更新 {len(updated)}人 / "
+           f"変更なし {unchanged}人 / 不正 {len(rejected)}行")
+    if rejected:
+        msg += "\n不正な行 (登録していません):\n" + "\n".join(
+            f"{line}行目: {reason}" for line, reason in rejected[:IMPORT_REJECTED_SHOWN])
+        if len(rejected) > IMPORT_REJECTED_SHOWN:
+            msg += f"\n他{len(rejected) - IMPORT_REJECTED_SHOWN}行"
+    return msg
+
+async def export_members_file(guild, fmt):
+    state = await get_state(guild)
+    await name_resolver.prefetch(guild, list(state.members))
+    data = write_roster(fmt, state.members, state.roles, LANES, partial(get_display_names, guild))
+    return discord.File(io.BytesIO(data), filename=f"members.{fmt}")
+
+@bot.command(name="import_members")
+async def import_members(ctx):
+    attachment = ctx.message.attachments[0] if ctx.message.attachments else None
+    await send_text(ctx.channel, await run_import_members(ctx.guild, attachment))
+
+@bot.tree.command(name="import_members", description="CSV / JSON ファイルからメンバーとパワーを一括登録します")
+@app_commands.describe(file="name, power 列のある CSV、またはメンバーのリストの JSON")
+async def slash_import_members(interaction: discord.Interaction, file: discord.Attachment):
+    # ファイルの読み込みに時間がかかっても応答期限を過ぎないよう先に応答を保留する
+    await interaction.response.defer()
+    for page in paginate((await run_import_members(interaction.guild, file)).split("\n")):
+        await interaction.followup.send(page)
+
+@bot.command(name="export_members")
+async def export_members(ctx, fmt: str = "csv"):
+    if fmt.lower() not in ROSTER_FORMATS:
+        await ctx.send("形式は csv か json で指定してください。")
+        return
+    await ctx.send(file=await export_members_file(ctx.guild, fmt.lower()))
+
+@bot.tree.command(name="export_members", description="登録メンバーとパワーを CSV / JSON ファイルで出力します")
+@app_commands.describe(format="csv または json")
+async def slash_export_members(interaction: discord.Interaction, format: str = "csv"):
+    if format.lower() not in ROSTER_FORMATS:
+        await interaction.response.send_message("形式は csv か json で指定してください。")
+        return
+    await interaction.response.defer()
+    await interaction.followup.send(file=await export_members_file(interaction.guild, format.lower()))
 
 @bot.tree.command(name="recruit", description="参加者募集メッセージを送信します")
 async def recruit(interaction: discord.Interaction):
-    global recruit_msg_id, recruit_channel_id, participants
+    # 募集メッセージの送信とリアクションの追加で応答期限を過ぎないよう、先に defer する
+    await interaction.response.defer()
+    state = await get_state(interaction.guild)
     msg = await interaction.channel.send("LoLカスタム参加募集！")
     await msg.add_reaction("👍")
     await msg.add_reaction("✅")
-    recruit_msg_id = msg.id
-    recruit_channel_id = msg.channel.id
-    participants.clear()
-    await interaction.response.send_message("参加者リストをリセットしました。")
+    # 参加者リストはギルドで1つなので、募集メッセージもギルドで1つにする (他のチャンネルの募集は無効になる)
+    recruit_messages = {str(msg.channel.id): msg.id}
+    state.settings['recruit_messages'] = recruit_messages
+    update_settings(interaction.guild.id, {'recruit_messages': recruit_messages})
+    state.synced_recruit_messages.add(msg.id)
+    state.participants.clear()
+    await interaction.followup.send("参加者リストをリセットしました。")
+
+# --- 募集メッセージへのリアクション ---
+# メッセージキャッシュに無いメッセージ (再起動前の募集など) でも届く raw イベントで受け取る
+
+# 再起動前に付いていた 👍 を参加者に反映する (募集メッセージごとに一度だけメッセージを取得する)
+async def sync_recruit_participants(state, channel, message_id):
+    if message_id in state.synced_recruit_messages:
+        return
+    state.synced_recruit_messages.add(message_id)
+    try:
+        message = await channel.fetch_message(message_id)
+    except discord.NotFound:
+        return
+    for reaction in message.reactions:
+        if str(reaction.emoji) == "👍":
+            async for user in reaction.users():
+                if not user.bot:
+                    state.participants.add(str(user.id))
+    await name_resolver.prefetch(channel.guild, state.participants)
+
+RECRUIT_EMOJIS = ("👍", "✅")
+
+async def recruit_reaction_target(payload):
+    # 募集に関係ない絵文字ではギルドの状態を読み込まない
+    if str(payload.emoji) not in RECRUIT_EMOJIS:
+        return None, None
+    if payload.guild_id is None or payload.user_id == bot.user.id:
+        return None, None
+    guild = bot.get_guild(payload.guild_id)
+    channel = guild and guild.get_channel_or_thread(payload.channel_id)
+    if channel is None:
+        return None, None
+    state = await get_state(guild)
+    if not state.is_recruit_message(payload.channel_id, payload.message_id):
+        return None, None
+    await sync_recruit_participants(state, channel, payload.message_id)
+    return state, channel
 
 @bot.event
-async def on_reaction_add(reaction, user):
-    if user.bot:
+async def on_raw_reaction_add(payload):
+    if payload.member is not None and payload.member.bot:
         return
-    if reaction.message.id != recruit_msg_id:
+    state, channel = await recruit_reaction_target(payload)
+    if state is None:
         return
-    if str(reaction.emoji) == "👍":
-        key_name = str(user.id)
-        if key_name not in participants:
-            participants.add(key_name)
-    elif str(reaction.emoji) == "✅":
-        channel = reaction.message.channel
+    if str(payload.emoji) == "👍":
+        name_resolver.remember(payload.member)
+        state.participants.add(str(payload.user_id))
+    elif str(payload.emoji) == "✅":
         class DummyCtx:
             def __init__(self, channel, guild):
                 self.channel = channel
                 self.guild = guild
             async def send(self, content=None, **kwargs):
-                await channel.send(content=content, **kwargs)
-        dummy_ctx = DummyCtx(channel, reaction.message.guild)
-        msg = validate_participant_count_message()
+                await outbox.send(channel, content, **kwargs)
+        dummy_ctx = DummyCtx(channel, channel.guild)
+        msg = validate_participant_count_message(state)
         if msg is not None:
             await channel.send(msg)
             return
         await make_teams_cmd(dummy_ctx)
 
 @bot.event
-async def on_reaction_remove(reaction, user):
-    if user.bot:
+async def on_raw_reaction_remove(payload):
+    state, channel = await recruit_reaction_target(payload)
+    if state is None:
         return
-    if reaction.message.id != recruit_msg_id:
-        return
-    if str(reaction.emoji) == "👍":
-        key_name = str(user.id)
-        if key_name in participants:
-            participants.remove(key_name)
+    if str(payload.emoji) == "👍":
+        state.participants.discard(str(payload.user_id))
 
-@bot.command(name="make_teams")
-async def make_teams_cmd(ctx, *args):
-    msg = validate_participant_count_message()
+# --- same: / diff: / captain: の指定 ---
+# !make_teams same:A,B diff:C,D captain:E,F のように指定する (same / diff は複数指定可)。
+# スラッシュコマンドでは各オプションに「A,B」の形で指定し、複数の組は「;」で区切る
+def parse_constraints(args):
+    groups = {'same': [], 'diff': [], 'captain': []}
+    for arg in args:
+        kind, sep, value = arg.partition(":")
+        if not sep or kind not in groups:
+            raise ValueError(f"不明な指定です: {arg}")
+        groups[kind].append([extract_name(name.strip()) for name in value.split(",") if name.strip()])
+    return TeamConstraints(groups['same'], groups['diff'], [name for names in groups['captain'] for name in names])
+
+def constraint_options(same=None, diff=None, captain=None):
+    args = []
+    for kind, value in (('same', same), ('diff', diff), ('captain', captain)):
+        args += [f"{kind}:{group}" for group in (value or "").split(";") if group.strip()]
+    return args
+
+# 指定を読み取り、(制約, エラーメッセージ) を返す
+def read_constraints(guild, state, args):
+    try:
+        constraints = parse_constraints(args)
+    except ValueError as e:
+        return None, str(e)
+    missing = constraints.names() - state.participants
+    if missing:
+        return None, f"参加者ではないメンバーが指定されています: {', '.join(get_display_names(guild, sorted(missing)))}"
+    return constraints, None
+
+# 探索には参加者の分だけ切り出したデータを渡す (プロセスプールでは引数が pickle されるため)
+def participant_powers(state, names):
+    return {n: state.members.get(n, 0) for n in names}
+
+# 制約がある場合は制約を満たす分割だけを列挙して評価する。
+# ロールモードではレーン割り当て後の戦力で比べ、(RankedSplits, LaneAssigner) を返す (通常は LaneAssigner が None)
+async def make_team_candidates(state, names, constraints):
+    roles = {n: state.roles[n] for n in names if n in state.roles} if state.role_mode else None
+    with search_duration.time(mode="make_teams"):
+        ranked, assigner = await search_pool.run(
+            team_candidates, names, participant_powers(state, names), state.history_index, constraints,
+            roles, state.off_role_penalty, SEARCH_TIME_BUDGET)
+    search_candidates.observe(ranked.explored, mode="make_teams")
+    if ranked.explored < ranked.total:
+        search_budget_exhausted.inc(mode="make_teams")
+    return ranked, assigner
+
+# 参加者・パワー (ロールモードではロール情報も)・履歴・指定が変わっていない間だけ /reroll で候補を使い回す
+def roll_cache_key(state, constraint_args):
+    names = sorted(state.participants)
+    roles = None
+    if state.role_mode:
+        roles = (state.off_role_penalty, tuple(json.dumps(state.roles.get(n), sort_keys=True) for n in names))
+    return (tuple(names), tuple(state.members.get(n, 0) for n in names), roles,
+            state.history_version, tuple(constraint_args))
+
+def build_teams_embed(guild, state, team1, team2, assigner=None):
+    members = state.members
+    embed = discord.Embed(color=0xffa500)
+    for i, team in enumerate((team1, team2), start=1):
+        if assigner is None:
+            sorted_team = sorted(team, key=lambda n: members.get(n, 0), reverse=True)
+            embed.add_field(
+                name=f"チーム{i} (合計: {sum(members.get(n, 0) for n in team)})",
+                value=" ".join(f"[ {name} ]" for name in get_display_names(guild, sorted_team)),
+                inline=False)
+        else:
+            lanes = assigner.assign(team)
+            sorted_team = sorted(team, key=lambda n: LANES.index(lanes[n]))
+            embed.add_field(
+                name=f"チーム{i} (戦力: {assigner.strength(assigner.team_mask(team))})",
+                value=" ".join(f"[ {lanes[n]}: {name} ]"
+                               for n, name in zip(sorted_team, get_display_names(guild, sorted_team))),
+                inline=False)
+    return embed
+
+# 5v5 のチーム分けを1回行い、(Embed, 通知) を返す。チーム分けできない場合は Embed が None
+async def run_make_teams(guild, state, constraint_args):
+    msg = validate_participant_count_message(state)
     if msg is not None:
-        await ctx.send(msg)
-        return
-    global participants, members, history, power_diff_tolerance
-    names = list(participants)
+        return None, msg
+    history = state.history
+    names = list(state.participants)
     if len(names) != 10:
-        await ctx.send("参加者が10人ではありません。")
-        return
-    full_candidates = []
-    for comb in itertools.combinations(names, 5):
-        team1 = frozenset(comb)
-        team2 = frozenset(n for n in names if n not in comb)
-        sum1 = sum(members.get(n, 0) for n in team1)
-        sum2 = sum(members.get(n, 0) for n in team2)
-        diff = abs(sum1 - sum2)
-        repeat_score = member_repeat_score(team1, team2)
-        candidate = {
-            'team1': team1,
-            'team2': team2,
-            'diff': diff,
-            'repeat_score': repeat_score
-        }
-        full_candidates.append(candidate)
-    full_candidates.sort(key=lambda c: (c['repeat_score'], c['diff']))
-    selected = random.choice(full_candidates[:min(5, len(full_candidates))])
+        return None, "参加者が10人ではありません。"
+    constraints, msg = read_constraints(guild, state, constraint_args)
+    if msg is not None:
+        return None, msg
+    key = roll_cache_key(state, constraint_args)
+    try:
+        ranked, assigner = await make_team_candidates(state, names, constraints)
+    except ValueError as e:
+        return None, str(e)
+    # 探索はイベントループの外で行うため、その間に参加者・パワー・履歴が変わった結果は使わない
+    if roll_cache_key(state, constraint_args) != key:
+        return None, "チーム分けの途中で参加者などが変わりました。もう一度実行してください。"
+    # キャプテン指定がある場合はチーム番号を入れ替えない
+    picked = pick_teams(ranked, history[-1] if history else None, keep_order=bool(constraints.captains))
+    if picked is None:
+        return None, "指定を満たすチーム分けがありません。"
+    selected, team1, team2, queue = picked
+    keys = record_history(state, [(team1, team2)])
+    # 選ばれなかった上位候補 (良い順) とヒープの残りを /reroll 用に残す
+    state.roll_cache = {
+        'key': roll_cache_key(state, constraint_args),
+        'args': tuple(constraint_args),
+        'history_key': keys[0],
+        'queue': queue,
+        'ranked': ranked,
+        'assigner': assigner,
+        'keep_order': bool(constraints.captains),
+    }
+    embed, notice = teams_result(guild, state, selected, team1, team2, assigner)
+    if ranked.explored < ranked.total:
+        partial_notice = f"制限時間内に{ranked.total}通り中{ranked.explored}通りを評価した中から選びました。"
+        notice = f"{notice}\n{partial_notice}" if notice else partial_notice
+    return embed, notice
+
+def teams_result(guild, state, selected, team1, team2, assigner):
+    embed = build_teams_embed(guild, state, team1, team2, assigner)
+    if selected['diff'] > state.power_diff_tolerance:
+        return embed, f"パワー差許容範囲内（{state.power_diff_tolerance}）のチーム分けが見つかりませんでした。"
+    return embed, None
+
+# 直前のチーム分けを、再計算せずに次点の分割で置き換える
+def run_reroll(guild, state):
+    cache = state.roll_cache
+    if cache is None or cache['key'] != roll_cache_key(state, cache['args']):
+        state.roll_cache = None
+        return None, "引き直せるチーム分けがありません。(参加者・パワー・履歴が変わった場合は make_teams からやり直してください)"
+    selected = cache['queue'].pop(0) if cache['queue'] else cache['ranked'].pop()
+    if selected is None:
+        return None, "これ以上の候補はありません。"
     team1 = selected['team1']
     team2 = selected['team2']
-    if history:
-        prev_team1, prev_team2 = history[-1]
+    # 置き換える前の履歴 (直前のチーム分けより前) と比べてチーム番号を決める
+    if len(state.history) > 1 and not cache['keep_order']:
+        prev_team1, prev_team2 = state.history[-2]
         team1, team2 = decide_swap(team1, team2, prev_team1, prev_team2)
-    history.append((team1, team2))
-    if len(history) > 10:
-        history.pop(0)
-    save_history([(list(t[0]), list(t[1])) for t in history])
-    sorted_team1 = sorted(team1, key=lambda n: members.get(n, 0), reverse=True)
-    sorted_team2 = sorted(team2, key=lambda n: members.get(n, 0), reverse=True)
-    display_team1 = [get_display_name(ctx.guild, n) for n in sorted_team1]
-    display_team2 = [get_display_name(ctx.guild, n) for n in sorted_team2]
-    embed = discord.Embed(color=0xffa500)
-    embed.add_field(
-        name=f"チーム1 (合計: {sum(members.get(n, 0) for n in team1)})",
-        value=" ".join(f"[ {name} ]" for name in display_team1),
-        inline=False)
-    embed.add_field(
-        name=f"チーム2 (合計: {sum(members.get(n, 0) for n in team2)})",
-        value=" ".join(f"[ {name} ]" for name in display_team2),
-        inline=False)
-    if selected['diff'] > power_diff_tolerance:
-        await ctx.send(f"パワー差許容範囲内（{power_diff_tolerance}）のチーム分けが見つかりませんでした。")
-    await ctx.send(embed=embed)
+    replace_last_history(state, cache['history_key'], (team1, team2))
+    cache['key'] = roll_cache_key(state, cache['args'])
+    return teams_result(guild, state, selected, team1, team2, cache['assigner'])
+
+# ✅ の連打や !make_teams と /make_teams の同時実行は、ギルドごとに1回のチーム分けにまとめる
+# (参加者・履歴・引き直し用の候補はギルド単位なので、チャンネルが違っても同じロビーとして扱う)。
+# 最初の要求のチャンネルにだけ結果を投稿し、同じチャンネルで相乗りしたスラッシュコマンドには同じ結果を本人にだけ返す。
+# 別のチャンネルから相乗りした要求は、そのチャンネルにも結果を投稿する
+roll_coordinator = RollCoordinator(debounce=float(os.environ.get("ROLL_DEBOUNCE", 0.5)))
+
+# (結果, チャンネルに投稿するか) を返す
+async def coordinated_roll(guild, channel_id, func, variant):
+    async def roll():
+        result = func()
+        if inspect.isawaitable(result):
+            result = await result
+        return result, channel_id
+    (result, posted_channel_id), first = await roll_coordinator.run(guild.id, roll, variant=variant)
+    if not first:
+        rolls_coalesced.inc()
+    return result, first or posted_channel_id != channel_id
+
+async def coordinated_make_teams(guild, channel_id, state, constraint_args):
+    return await coordinated_roll(guild, channel_id, partial(run_make_teams, guild, state, constraint_args),
+                                  variant=tuple(constraint_args))
+
+# スラッシュコマンドは待ち時間 (debounce・ロック・探索) が応答期限の3秒を超えうるため、先に defer してから結果を送る。
+# 投稿しない (相乗りした) 要求は「考え中」の表示を消し、同じ結果を本人にだけ返す
+async def send_roll_result(interaction, embed, notice, post):
+    if not post:
+        await interaction.delete_original_response()
+    if embed is None:
+        await interaction.followup.send(notice, ephemeral=not post)
+        return
+    await interaction.followup.send(notice, embed=embed, ephemeral=not post)
+
+@bot.command(name="make_teams")
+async def make_teams_cmd(ctx, *args):
+    state = await get_state(ctx.guild)
+    (embed, notice), post = await coordinated_make_teams(ctx.guild, ctx.channel.id, state, args)
+    if not post:
+        return
+    if notice:
+        await ctx.send(notice)
+    if embed:
+        await ctx.send(embed=embed)
 
 @bot.tree.command(name="make_teams", description="10人の参加者を5v5に分ける標準的なチーム分け")
-async def slash_make_teams(interaction: discord.Interaction):
-    msg = validate_participant_count_message()
-    if msg is not None:
-        await interaction.response.send_message(msg)
+@app_commands.describe(same="同じチームにするメンバー (例: A,B / 複数の組は ; で区切る)",
+                       diff="別のチームにするメンバー (例: A,B / 複数の組は ; で区切る)",
+                       captain="チーム1, チーム2 のキャプテン (例: A,B)")
+async def slash_make_teams(interaction: discord.Interaction, same: str = None, diff: str = None, captain: str = None):
+    await interaction.response.defer()
+    state = await get_state(interaction.guild)
+    (embed, notice), post = await coordinated_make_teams(
+        interaction.guild, interaction.channel_id, state, constraint_options(same, diff, captain))
+    await send_roll_result(interaction, embed, notice, post)
+
+@bot.command(name="reroll")
+async def reroll_cmd(ctx):
+    state = await get_state(ctx.guild)
+    (embed, notice), post = await coordinated_roll(ctx.guild, ctx.channel.id, partial(run_reroll, ctx.guild, state),
+                                                   variant="reroll")
+    if not post:
         return
-    global participants, members, history, power_diff_tolerance
-    names = list(participants)
-    if len(names) != 10:
-        await interaction.response.send_message("参加者が10人ではありません。")
-        return
-    full_candidates = []
-    for comb in itertools.combinations(names, 5):
-        team1 = frozenset(comb)
-        team2 = frozenset(n for n in names if n not in comb)
-        sum1 = sum(members.get(n, 0) for n in team1)
-        sum2 = sum(members.get(n, 0) for n in team2)
-        diff = abs(sum1 - sum2)
-        repeat_score = member_repeat_score(team1, team2)
-        candidate = {
-            'team1': team1,
-            'team2': team2,
-            'diff': diff,
-            'repeat_score': repeat_score
-        }
-        full_candidates.append(candidate)
-    full_candidates.sort(key=lambda c: (c['repeat_score'], c['diff']))
-    selected = random.choice(full_candidates[:min(5, len(full_candidates))])
-    team1 = selected['team1']
-    team2 = selected['team2']
-    if history:
-        prev_team1, prev_team2 = history[-1]
-        team1, team2 = decide_swap(team1, team2, prev_team1, prev_team2)
-    history.append((team1, team2))
-    if len(history) > 10:
-        history.pop(0)
-    save_history([(list(t[0]), list(t[1])) for t in history])
-    sorted_team1 = sorted(team1, key=lambda n: members.get(n, 0), reverse=True)
-    sorted_team2 = sorted(team2, key=lambda n: members.get(n, 0), reverse=True)
-    display_team1 = [get_display_name(interaction.guild, n) for n in sorted_team1]
-    display_team2 = [get_display_name(interaction.guild, n) for n in sorted_team2]
-    embed = discord.Embed(color=0xffa500)
-    embed.add_field(
-        name=f"チーム1 (合計: {sum(members.get(n, 0) for n in team1)})",
-        value=" ".join(f"[ {name} ]" for name in display_team1),
-        inline=False)
-    embed.add_field(
-        name=f"チーム2 (合計: {sum(members.get(n, 0) for n in team2)})",
-        value=" ".join(f"[ {name} ]" for name in display_team2),
-        inline=False)
-    if selected['diff'] > power_diff_tolerance:
-        await interaction.response.send_message(f"パワー差許容範囲内（{power_diff_tolerance}）のチーム分けが見つかりませんでした。")
-        return
-    await interaction.response.send_message(embed=embed)
+    if notice:
+        await ctx.send(notice)
+    if embed:
+        await ctx.send(embed=embed)
+
+@bot.tree.command(name="reroll", description="直前のチーム分けを次点の候補で引き直します")
+async def slash_reroll(interaction: discord.Interaction):
+    await interaction.response.defer()
+    state = await get_state(interaction.guild)
+    (embed, notice), post = await coordinated_roll(
+        interaction.guild, interaction.channel_id, partial(run_reroll, interaction.guild, state), variant="reroll")
+    await send_roll_result(interaction, embed, notice, post)
+
+# --- 10人を超える場合のチーム分け (複数ロビー・人数の異なる2チーム) ---
+def record_lobby_history(state, result):
+    record_history(state, [(result['teams'][i], result['teams'][i + 1]) for i in range(0, len(result['teams']), 2)])
+
+# Embed 1つのフィールドは25個までなので、ロビーが多いときは複数の Embed に分ける (ロビーの途中では分けない)
+def build_lobbies_embeds(guild, state, result):
+    members = state.members
+    teams = result['teams']
+    fields = []
+    for i in range(0, len(teams), 2):
+        lobby = f"ロビー{i // 2 + 1} " if len(teams) > 2 else ""
+        for j, team in enumerate((teams[i], teams[i + 1]), start=1):
+            sorted_team = sorted(team, key=lambda n: members.get(n, 0), reverse=True)
+            fields.append((f"{lobby}チーム{j} (合計: {result['sums'][i + j - 1]})",
+                           " ".join(f"[ {name} ]" for name in get_display_names(guild, sorted_team))))
+    if result.get('bench'):
+        fields.append(("待機", " ".join(f"[ {name} ]" for name in get_display_names(guild, result['bench']))))
+    per_embed = EMBED_FIELD_LIMIT - EMBED_FIELD_LIMIT % 2
+    embeds = []
+    for i in range(0, len(fields), per_embed):
+        embed = discord.Embed(color=0xffa500)
+        for name, value in fields[i:i + per_embed]:
+            embed.add_field(name=name, value=value, inline=False)
+        embeds.append(embed)
+    if result['exhaustive']:
+        embeds[-1].set_footer(text=f"全{result['explored']}通りを評価しました")
+    else:
+        embeds[-1].set_footer(text=f"制限時間内に{result['explored']}通りを評価しました")
+    return embeds
+
+def tolerance_exceeded_message(state, result):
+    if any(diff > state.power_diff_tolerance for diff in result['diffs']):
+        return f"パワー差許容範囲内（{state.power_diff_tolerance}）のチーム分けが見つからないロビーがあります。"
+    return None
+
+def observe_search(result, mode):
+    search_candidates.observe(result['explored'], mode=mode)
+    if not result['exhaustive']:
+        search_budget_exhausted.inc(mode=mode)
+
+async def run_make_lobbies(state, team_size, constraints=None):
+    participants = list(state.participants)
+    if team_size < 1:
+        return None, "チームの人数は1以上で指定してください。"
+    if len(participants) < team_size * 2:
+        return None, f"参加者があと{team_size * 2 - len(participants)}人必要です。"
+    try:
+        with search_duration.time(mode="make_lobbies"):
+            result = await search_pool.run(
+                make_lobbies, participants, participant_powers(state, participants), state.history_index,
+                team_size=team_size, tolerance=state.power_diff_tolerance, time_budget=SEARCH_TIME_BUDGET,
+                constraints=constraints)
+    except ValueError as e:
+        return None, str(e)
+    observe_search(result, "make_lobbies")
+    record_lobby_history(state, result)
+    return result, tolerance_exceeded_message(state, result)
+
+async def run_split_teams(state, constraints=None):
+    participants = list(state.participants)
+    if len(participants) < 2:
+        return None, "参加者が2人以上必要です。"
+    count = len(participants)
+    try:
+        with search_duration.time(mode="split_teams"):
+            result = await search_pool.run(
+                search_teams, participants, participant_powers(state, participants),
+                [count // 2, count - count // 2], state.history_index, tolerance=state.power_diff_tolerance,
+                time_budget=SEARCH_TIME_BUDGET, constraints=constraints)
+    except ValueError as e:
+        return None, str(e)
+    observe_search(result, "split_teams")
+    record_lobby_history(state, result)
+    return result, tolerance_exceeded_message(state, result)
+
+@bot.command(name="make_lobbies")
+async def make_lobbies_cmd(ctx, team_size: int = 5, *args):
+    state = await get_state(ctx.guild)
+    constraints, notice = read_constraints(ctx.guild, state, args)
+    if notice is not None:
+        await ctx.send(notice)
+        return
+    result, notice = await run_make_lobbies(state, team_size, constraints)
+    if result is None:
+        await ctx.send(notice)
+        return
+    await outbox.send_embeds(ctx.channel, build_lobbies_embeds(ctx.guild, state, result), notice)
+
+@bot.tree.command(name="make_lobbies", description="参加者を複数の対戦ロビーに分けてチーム分けします")
+@app_commands.describe(same="同じチームにするメンバー (例: A,B / 複数の組は ; で区切る)",
+                       diff="別のチームにするメンバー (例: A,B / 複数の組は ; で区切る)",
+                       captain="チーム1, チーム2, ... のキャプテン (例: A,B,C,D)")
+async def slash_make_lobbies(interaction: discord.Interaction, team_size: int = 5,
+                             same: str = None, diff: str = None, captain: str = None):
+    state = await get_state(interaction.guild)
+    constraints, notice = read_constraints(interaction.guild, state, constraint_options(same, diff, captain))
+    if notice is not None:
+        await interaction.response.send_message(notice)
+        return
+    result, notice = await run_make_lobbies(state, team_size, constraints)
+    if result is None:
+        await interaction.response.send_message(notice)
+        return
+    await respond_embeds(interaction, build_lobbies_embeds(interaction.guild, state, result), notice)
+
+@bot.command(name="split_teams")
+async def split_teams_cmd(ctx, *args):
+    state = await get_state(ctx.guild)
+    constraints, notice = read_constraints(ctx.guild, state, args)
+    if notice is not None:
+        await ctx.send(notice)
+        return
+    result, notice = await run_split_teams(state, constraints)
+    if result is None:
+        await ctx.send(notice)
+        return
+    await outbox.send_embeds(ctx.channel, build_lobbies_embeds(ctx.guild, state, result), notice)
+
+@bot.tree.command(name="split_teams", description="参加者全員を人数差1以内の2チームに分けます")
+@app_commands.describe(same="同じチームにするメンバー (例: A,B / 複数の組は ; で区切る)",
+                       diff="別のチームにするメンバー (例: A,B / 複数の組は ; で区切る)",
+                       captain="チーム1, チーム2 のキャプテン (例: A,B)")
+async def slash_split_teams(interaction: discord.Interaction, same: str = None, diff: str = None, captain: str = None):
+    state = await get_state(interaction.guild)
+    constraints, notice = read_constraints(interaction.guild, state, constraint_options(same, diff, captain))
+    if notice is not None:
+        await interaction.response.send_message(notice)
+        return
+    result, notice = await run_split_teams(state, constraints)
+    if result is None:
+        await interaction.response.send_message(notice)
+        return
+    await respond_embeds(interaction, build_lobbies_embeds(interaction.guild, state, result), notice)
+
+# --- 全履歴の累計 (試合数・よく同じチームになる相手) ---
+async def player_stats_message(guild, state, name):
+    key_name = extract_name(name)
+    teammates = sorted(state.stats.teammates(key_name).items(), key=lambda item: item[1], reverse=True)[:3]
+    display_name, *names = await fetch_display_names(guild, [key_name, *(n for n, _ in teammates)])
+    matches = state.stats.matches.get(key_name, 0)
+    if not matches:
+        return f"{display_name} の試合記録はありません。"
+    lines = [f"{display_name} の試合数: {matches}"]
+    if teammates:
+        lines.append("よく同じチームになる相手: " + ", ".join(f"{d} ({c}回)" for d, (_, c) in zip(names, teammates)))
+    return "\n".join(lines)
+
+@bot.command(name="player_stats")
+async def player_stats_cmd(ctx, name):
+    state = await get_state(ctx.guild)
+    await ctx.send(await player_stats_message(ctx.guild, state, name))
+
+@bot.tree.command(name="player_stats", description="メンバーの試合数とよく同じチームになる相手を表示します")
+async def slash_player_stats(interaction: discord.Interaction, name: str):
+    state = await get_state(interaction.guild)
+    await interaction.response.send_message(await player_stats_message(interaction.guild, state, name))
 
 @bot.command(name="commands")
 async def commands_list(ctx):
@@ -531,11 +1198,19 @@ async def commands_list(ctx):
     prefix_only_commands = [
         {"name": "add_member", "desc": "メンバーとパワーを登録します", "usage": f"{prefix}add_member メンバー名 パワー"},
         {"name": "remove_member", "desc": "登録済みメンバーを削除します", "usage": f"{prefix}remove_member メンバー名"},
+        {"name": "import_members", "desc": "添付した CSV / JSON ファイルからメンバーとパワーを一括登録します", "usage": f"{prefix}import_members (ファイルを添付)"},
+        {"name": "export_members", "desc": "登録メンバーとパワーをファイルで出力します", "usage": f"{prefix}export_members csv"},
         {"name": "join", "desc": "参加します", "usage": f"{prefix}join メンバー名"},
         {"name": "leave", "desc": "参加をキャンセルします", "usage": f"{prefix}leave メンバー名"},
         {"name": "set_initial_power", "desc": "未登録メンバーの初期パワーを設定します", "usage": f"{prefix}set_initial_power 数値"},
         {"name": "show_initial_power", "desc": "現在の初期パワーを表示します", "usage": f"{prefix}show_initial_power"},
-        {"name": "make_teams", "desc": "参加者10人を5v5でチーム分けします", "usage": f"{prefix}make_teams same:メンバー diff:メンバー"},
+        {"name": "set_roles", "desc": "レーン別のパワーと希望レーンを登録します (clear で削除)", "usage": f"{prefix}set_roles メンバー名 TOP:60 MID:70 pref:MID,TOP"},
+        {"name": "show_roles", "desc": "レーン別のパワーと希望レーンを表示します", "usage": f"{prefix}show_roles メンバー名"},
+        {"name": "make_teams", "desc": "参加者10人を5v5でチーム分けします", "usage": f"{prefix}make_teams same:A,B diff:C,D captain:E,F"},
+        {"name": "reroll", "desc": "直前のチーム分けを次点の候補で引き直します", "usage": f"{prefix}reroll"},
+        {"name": "make_lobbies", "desc": "参加者を複数のロビーに分けてチーム分けします (端数は待機)", "usage": f"{prefix}make_lobbies 5 same:A,B diff:C,D"},
+        {"name": "split_teams", "desc": "参加者全員を人数差1以内の2チームに分けます", "usage": f"{prefix}split_teams same:A,B diff:C,D"},
+        {"name": "player_stats", "desc": "メンバーの試合数とよく同じチームになる相手を表示します", "usage": f"{prefix}player_stats メンバー名"},
         {"name": "commands", "desc": "コマンド一覧を表示します", "usage": f"{prefix}commands"},
     ]
     embed = discord.Embed(title="利用可能なプレフィックスコマンド一覧", color=0x3498db)
@@ -546,14 +1221,41 @@ async def commands_list(ctx):
             inline=False)
     await ctx.send(embed=embed)
 
+@bot.event
+async def on_member_join(member):
+    name_resolver.member_joined(member)
+
+@bot.event
+async def on_member_update(before, after):
+    name_resolver.member_updated(before, after)
+
+@bot.event
+async def on_member_remove(member):
+    name_resolver.member_removed(member)
+
+@bot.event
+async def on_user_update(before, after):
+    name_resolver.user_updated(before, after)
+
+@bot.event
+async def on_guild_remove(guild):
+    name_resolver.invalidate(guild.id)
+
 @bot.event
 async def on_ready():
     print(f"Logged in as {bot.user} (ID: {bot.user.id})")
+    if not bot.startup_reported:
+        bot.startup_reported = True
+        print(f"起動にかかった時間: {time.perf_counter() - started_at:.2f}秒")
     print("------")
 
-if __name__ == "__main__":
+def main():
     TOKEN = os.environ.get("DISCORD_TOKEN")
     if not TOKEN:
         raise ValueError("環境変数DISCORD_TOKENがセットされていません")
+    init_storage()
+    threading.Thread(target=run_flask, daemon=True).start()
     bot.run(TOKEN)
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import math
+import threading
+import time
+
+# --- Prometheus テキスト形式のメトリクス ---
+# Flask のスレッドから読まれ、イベントループや executor のスレッドから書かれるため、
+# 各メトリクスはロックで保護する
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (str(v).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"') for _, v in pairs)
+    return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+def _format_value(value):
+    if math.isnan(value):
+        return "NaN"
+    if math.isinf(value):
+        return "+Inf" if value > 0 else "-Inf"
+    return repr(float(value))
+
+class Counter:
+    type_name = "counter"
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels[n]) for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _format_labels(self.labels, key), value) for key, value in self._values.items()]
+
+class Histogram:
+    type_name = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[n]) for n in self.labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    # with histogram.time(command="join"): ... の形で経過時間を記録する
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        result = []
+        with self._lock:
+            for key, (counts, total) in self._values.items():
+                for bound, count in zip(self.buckets, counts):
+                    le = "+Inf" if math.isinf(bound) else repr(bound)
+                    result.append((f"{self.name}_bucket", _format_labels(self.labels, key, [("le", le)]), count))
+                result.append((f"{self.name}_sum", _format_labels(self.labels, key), total))
+                result.append((f"{self.name}_count", _format_labels(self.labels, key), counts[-1]))
+        return result
+
+class _Timer:
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+        return False
+
+# 読み出し時に func() を呼んで値を得るゲージ。func は数値か {ラベル値のタプル: 数値} を返す
+class CallbackGauge:
+    type_name = "gauge"
+
+    def __init__(self, name, help, func, labels=()):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labels = tuple(labels)
+
+    def samples(self):
+        value = self.func()
+        if isinstance(value, dict):
+            return [(self.name, _format_labels(self.labels, key), v) for key, v in value.items()]
+        return [(self.name, "", value)]
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.register(Counter(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labels, buckets))
+
+    def gauge(self, name, help, func, labels=()):
+        return self.register(CallbackGauge(name, help, func, labels))
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+# --- 計測付きのプロキシ ---
+# target のメソッド呼び出しごとに所要時間を histogram へ、例外を errors へ記録する
+class Instrumented:
+    def __init__(self, target, histogram, errors, label="operation"):
+        self._target = target
+        self._histogram = histogram
+        self._errors = errors
+        self._label = label
+
+    def __getattr__(self, name):
+        attr = getattr(self._target, name)
+        if not callable(attr):
+            return attr
+
+        def wrapper(*args, **kwargs):
+            labels = {self._label: name}
+            start = time.perf_counter()
+            try:
+                return attr(*args, **kwargs)
+            except Exception:
+                self._errors.inc(**labels)
+                raise
+            finally:
+                self._histogram.observe(time.perf_counter() - start, **labels)
+
+        return wrapper
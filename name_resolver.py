@@ -0,0 +1,153 @@
+import asyncio
+import time
+
+# --- 表示名の解決 ---
+# ギルドごとに「ユーザーID -> メンバー」「ユーザー名 -> ユーザーID」の索引を初回参照時に作り、
+# 以降は on_member_join / on_member_update / on_member_remove / on_user_update で差分更新する。
+# 参加者のキーはユーザーIDの文字列か、ユーザー名のどちらか。
+# メンバー一覧をキャッシュしない設定 (MEMBER_CACHE_POLICY=participants) では guild.members がほぼ空になるため、
+# 参加者・登録メンバーの分だけを remember / prefetch で別の索引 (known) に持つ。
+# この設定ではメンバーの更新・退出イベントが届かないため、known の各エントリーは ttl 秒で期限切れにし、
+# 次の prefetch で問い合わせ直す (ギルドにいなかった ID も期限が切れたら問い合わせ直す)
+class DisplayNameResolver:
+    QUERY_BATCH = 100
+
+    def __init__(self, ttl=600.0):
+        self.ttl = ttl
+        self._guilds = {}
+        # ギルドID -> (ユーザーID -> メンバー, ユーザー名 -> ユーザーID, ユーザーID -> 取得した時刻)
+        self._known = {}
+
+    def _index(self, guild):
+        index = self._guilds.get(guild.id)
+        if index is None:
+            index = ({}, {})
+            for member in guild.members:
+                self._add(index, member)
+            # メンバー一覧の取得 (chunk) が終わる前の索引は不完全なので保持しない
+            if guild.chunked:
+                self._guilds[guild.id] = index
+        return index
+
+    @staticmethod
+    def _add(index, member):
+        by_id, by_name = index
+        by_id[str(member.id)] = member
+        by_name.setdefault(member.name, str(member.id))
+
+    @staticmethod
+    def _remove(index, member):
+        by_id, by_name = index
+        by_id.pop(str(member.id), None)
+        if by_name.get(member.name) == str(member.id):
+            del by_name[member.name]
+
+    def _known_index(self, guild_id):
+        return self._known.setdefault(guild_id, ({}, {}, {}))
+
+    def _indexes(self, guild):
+        known = self._known.get(guild.id)
+        return self._index(guild), known[:2] if known else ({}, {})
+
+    @staticmethod
+    def _display_name(indexes, name):
+        for by_id, by_name in indexes:
+            member = by_id.get(name) or by_id.get(by_name.get(name))
+            if member is not None:
+                return member.display_name
+        return name
+
+    def resolve(self, guild, name):
+        if guild is None:
+            return name
+        return self._display_name(self._indexes(guild), name)
+
+    def resolve_many(self, guild, names):
+        if guild is None:
+            return list(names)
+        indexes = self._indexes(guild)
+        return [self._display_name(indexes, name) for name in names]
+
+    # リアクションやコマンドで受け取ったメンバーを覚えておく
+    def remember(self, member):
+        if member is not None and getattr(member, 'guild', None) is not None:
+            known = self._known_index(member.guild.id)
+            self._replace(known, str(member.id), member)
+            known[2][str(member.id)] = time.monotonic()
+
+    # known のユーザーIDのエントリーを member (ギルドにいなければ None) で置き換える
+    def _replace(self, known, user_id, member):
+        old = known[0].get(user_id)
+        if old is not None:
+            self._remove(known[:2], old)
+        if member is None:
+            known[0][user_id] = None
+        else:
+            self._add(known[:2], member)
+
+    # 表示名の分からない (または期限切れの) ユーザーIDをまとめて問い合わせる
+    # (gateway の REQUEST_GUILD_MEMBERS、1回100人まで)。
+    # ギルドにいないIDは None として覚え、期限が切れるまでは問い合わせない
+    async def prefetch(self, guild, names):
+        if guild is None:
+            return
+        by_id, _ = self._index(guild)
+        known = self._known_index(guild.id)
+        now = time.monotonic()
+        missing = sorted({int(n) for n in names
+                          if n.isdigit() and n not in by_id and now - known[2].get(n, -self.ttl) >= self.ttl})
+        for i in range(0, len(missing), self.QUERY_BATCH):
+            batch = missing[i:i + self.QUERY_BATCH]
+            # 問い合わせ中の ID は取得済みとして扱い、並行する prefetch で重ねて問い合わせない
+            for user_id in batch:
+                known[2][str(user_id)] = now
+            try:
+                members = await guild.query_members(user_ids=batch, limit=len(batch), cache=False)
+            except asyncio.TimeoutError:
+                print(f"メンバー情報の取得がタイムアウトしました (guild={guild.id})")
+                for user_id in missing[i:]:
+                    known[2].pop(str(user_id), None)
+                return
+            found = {str(member.id): member for member in members}
+            for user_id in batch:
+                self._replace(known, str(user_id), found.get(str(user_id)))
+
+    def invalidate(self, guild_id=None):
+        if guild_id is None:
+            self._guilds.clear()
+            self._known.clear()
+        else:
+            self._guilds.pop(guild_id, None)
+            self._known.pop(guild_id, None)
+
+    # 使われなくなったギルドの known を破棄する (メンバー一覧の索引は残す)
+    def forget(self, guild_id):
+        self._known.pop(guild_id, None)
+
+    # --- ゲートウェイイベントによる更新 (索引未作成のギルドは何もしない) ---
+    def member_joined(self, member):
+        index = self._guilds.get(member.guild.id)
+        if index is not None:
+            self._add(index, member)
+
+    def member_updated(self, before, after):
+        for indexes in (self._guilds, self._known):
+            index = indexes.get(after.guild.id)
+            if index is not None and (indexes is self._guilds or str(after.id) in index[0]):
+                self._remove(index[:2], before)
+                self._add(index[:2], after)
+
+    def member_removed(self, member):
+        index = self._guilds.get(member.guild.id)
+        if index is not None:
+            self._remove(index, member)
+
+    # ユーザー名の変更はギルドをまたぐため、全ギルドの索引を見直す
+    def user_updated(self, before, after):
+        user_id = str(after.id)
+        for by_id, by_name, *_ in (*self._guilds.values(), *self._known.values()):
+            if user_id not in by_id:
+                continue
+            if by_name.get(before.name) == user_id:
+                del by_name[before.name]
+            by_name.setdefault(after.name, user_id)
@@ -0,0 +1,104 @@
+import asyncio
+import time
+
+MESSAGE_LIMIT = 2000
+EMBED_FIELD_LIMIT = 25
+
+# --- 送信内容の分割 ---
+# 行のリストを、1通が limit 文字以内に収まる最小限の通数にまとめる。header は先頭のページにだけ付け、
+# code_block=True ならページごとにコードブロックで囲む。1行で収まらない行は途中で切る
+def paginate(lines, limit=MESSAGE_LIMIT, header="", code_block=False):
+    wrapper = 8 if code_block else 0  # "```\n" と "\n```"
+    room = limit - wrapper - len(header)
+    pieces = []
+    for line in lines:
+        if len(line) <= room:
+            pieces.append(line)
+        else:
+            pieces.extend(line[i:i + room] for i in range(0, len(line), room))
+    pages = []
+    current, size = [], 0
+    for piece in pieces:
+        added = len(piece) + (1 if current else 0)
+        if current and size + added > room:
+            pages.append(current)
+            current, size, added = [], 0, len(piece)
+            room = limit - wrapper
+        current.append(piece)
+        size += added
+    if current:
+        pages.append(current)
+    result = []
+    for i, page in enumerate(pages):
+        body = "\n".join(page)
+        result.append((header if i == 0 else "") + (f"```\n{body}\n```" if code_block else body))
+    return result
+
+# --- チャンネルごとの送信ペース ---
+# Discord のメッセージ送信はチャンネルごとに 5通/5秒 程度で制限される。discord.py は応答の
+# X-RateLimit-* ヘッダーや 429 を見てから待つため、一度に何通も送ると同じチャンネルの他の返信まで詰まる。
+# ここでは同じチャンネルへの送信を1通ずつ順番に行い、トークンバケットで送信前に間隔を空ける。
+# 送信中・待機中の送信が無く、バケットが満杯に戻ったチャンネルの状態は per 秒ごとにまとめて破棄する
+# (満杯のバケットは新しく作ったものと同じなので、破棄しても送信の間隔は変わらない)
+class Outbox:
+    def __init__(self, rate=5, per=5.0):
+        self.rate = rate
+        self.per = per
+        self._buckets = {}
+        self._locks = {}
+        # チャンネルID -> 送信中・ロック待ちの送信の数
+        self._active = {}
+        self._pruned_at = time.monotonic()
+
+    def _prune(self):
+        now = time.monotonic()
+        if now - self._pruned_at < self.per:
+            return
+        self._pruned_at = now
+        for channel_id, (tokens, last) in list(self._buckets.items()):
+            if channel_id not in self._active and tokens + (now - last) * self.rate / self.per >= self.rate:
+                del self._buckets[channel_id]
+                self._locks.pop(channel_id, None)
+
+    async def _acquire(self, channel_id):
+        now = time.monotonic()
+        tokens, last = self._buckets.get(channel_id, (self.rate, now))
+        tokens = min(self.rate, tokens + (now - last) * self.rate / self.per)
+        if tokens < 1:
+            await asyncio.sleep((1 - tokens) * self.per / self.rate)
+            now, tokens = time.monotonic(), 1
+        self._buckets[channel_id] = (tokens - 1, now)
+
+    async def send(self, channel, content=None, **kwargs):
+        self._active[channel.id] = self._active.get(channel.id, 0) + 1
+        try:
+            async with self._locks.setdefault(channel.id, asyncio.Lock()):
+                await self._acquire(channel.id)
+                return await channel.send(content, **kwargs)
+        finally:
+            self._active[channel.id] -= 1
+            if not self._active[channel.id]:
+                del self._active[channel.id]
+            self._prune()
+
+    async def send_pages(self, channel, pages):
+        for page in pages:
+            await self.send(channel, page)
+
+    async def send_embeds(self, channel, embeds, content=None):
+        for i, embed in enumerate(embeds):
+            await self.send(channel, content if i == 0 else None, embed=embed)
+
+# スラッシュコマンドへの返信を複数通に分ける (2通目以降と、応答を保留したあとはフォローアップ)
+def _first_reply(interaction):
+    return interaction.followup.send if interaction.response.is_done() else interaction.response.send_message
+
+async def respond_pages(interaction, pages, **kwargs):
+    await _first_reply(interaction)(pages[0], **kwargs)
+    for page in pages[1:]:
+        await interaction.followup.send(page, **kwargs)
+
+async def respond_embeds(interaction, embeds, content=None, **kwargs):
+    await _first_reply(interaction)(content, embed=embeds[0], **kwargs)
+    for embed in embeds[1:]:
+        await interaction.followup.send(embed=embed, **kwargs)
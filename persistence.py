@@ -0,0 +1,110 @@
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# --- 書き込みの遅延・集約 (write-behind) ---
+# Firebase への書き込みはイベントループ外 (executor) で実行する。
+# schedule_update: delay 秒の間に同じ key へ積まれた差分 (dict) はマージされ、1回のマルチパス update として送られる。
+# 失敗した書き込みは、その後に積まれた差分と合わせて retry_delay 秒後に再送する。
+# ただし再送しても直らない失敗 (PERMANENT_ERRORS: 保存先が受け付けないキーや値など) と、
+# max_attempts 回続けて失敗した書き込みは破棄し、同じ key のその後の書き込みを巻き込まないようにする。
+# on_error(key, error, dropped) は失敗のたびに呼ばれる (dropped は破棄したか)
+PERMANENT_ERRORS = (ValueError, TypeError)
+
+class WriteBehindWriter:
+    def __init__(self, delay=0.5, retry_delay=5.0, max_attempts=5, executor=None, on_error=None):
+        self.delay = delay
+        self.retry_delay = retry_delay
+        self.max_attempts = max_attempts
+        self.executor = executor
+        self.on_error = on_error
+        self.pending = {}
+        self.in_flight = set()
+        self.failures = 0
+        self.dropped = 0
+        self.last_error = None
+        # key -> 続けて失敗した回数
+        self._attempts = {}
+        self._task = None
+        self._lock = asyncio.Lock()
+        self._closed = False
+
+    def schedule_update(self, key, func, changes):
+        pending = self.pending.get(key)
+        if pending is not None:
+            changes = {**pending[1], **changes}
+        self._enqueue(key, (func, dict(changes)))
+
+    def _enqueue(self, key, write):
+        if self._closed:
+            raise RuntimeError("WriteBehindWriter は既に終了しています")
+        self.pending[key] = write
+        if self._task is None or self._task.done():
+            self._task = asyncio.get_running_loop().create_task(self._run(self.delay))
+
+    async def _run(self, delay):
+        await asyncio.sleep(delay)
+        async with self._lock:
+            failed = await self._write_pending()
+        # 書き込み中に追加された分、または失敗した分を次の周期で送る
+        if self.pending and not self._closed:
+            delay = self.retry_delay if failed else self.delay
+            self._task = asyncio.get_running_loop().create_task(self._run(delay))
+
+    async def _write_pending(self):
+        batch, self.pending = self.pending, {}
+        self.in_flight = set(batch)
+        loop = asyncio.get_running_loop()
+        try:
+            results = await asyncio.gather(
+                *(loop.run_in_executor(self.executor, func, changes) for func, changes in batch.values()),
+                return_exceptions=True)
+        finally:
+            self.in_flight = set()
+        failed = False
+        for (key, write), result in zip(batch.items(), results):
+            if not isinstance(result, Exception):
+                self._attempts.pop(key, None)
+                continue
+            failed = True
+            self.failures += 1
+            self.last_error = result
+            attempts = self._attempts.get(key, 0) + 1
+            dropped = isinstance(result, PERMANENT_ERRORS) or attempts >= self.max_attempts
+            if dropped:
+                self.dropped += 1
+                self._attempts.pop(key, None)
+                logger.error("保存に失敗したため破棄しました (%s, %d回目): %r", key, attempts, result)
+            else:
+                self._attempts[key] = attempts
+                logger.error("保存に失敗しました (%s, %d回目): %r", key, attempts, result)
+            if self.on_error is not None:
+                self.on_error(key, result, dropped)
+            if dropped:
+                continue
+            newer = self.pending.get(key)
+            if newer is None:
+                self.pending[key] = write
+            else:
+                # 失敗した差分の上に、その後に積まれた差分を重ねて再送する
+                self.pending[key] = (newer[0], {**write[1], **newer[1]})
+        return failed
+
+    # 未送信の書き込みをすべて送る。失敗が残った場合は最後のエラーを送出する
+    async def flush(self):
+        # 待機中の周期は取り消し、書き込み中の周期はその完了を待つ
+        if self._task is not None and not self._task.done() and not self._lock.locked():
+            self._task.cancel()
+        async with self._lock:
+            failed = bool(self.pending) and await self._write_pending()
+        if failed:
+            raise self.last_error
+
+    async def close(self):
+        try:
+            await self.flush()
+        finally:
+            self._closed = True
+            if self.pending:
+                logger.error("保存されなかった書き込みがあります: %s", ", ".join(map(str, self.pending)))
@@ -0,0 +1,48 @@
+import asyncio
+import inspect
+
+# --- チーム分けの実行の調整 ---
+# 同じロビー (ギルド) に短い間隔で重なったチーム分けの要求を1回の実行にまとめ、結果を全員で共有する。
+# 最初の要求から debounce 秒待つ間と実行中に届いた同じ内容 (variant) の要求は同じ実行に相乗りし、
+# 実行そのものはロビーごとに1つずつ順番に行う
+class RollCoordinator:
+    def __init__(self, debounce=0.5):
+        self.debounce = debounce
+        self._pending = {}
+        self._locks = {}
+
+    # func はロビーのロックを持った状態で呼ばれる関数 (コルーチン関数も可)。(結果, 最初の要求か) を返す
+    async def run(self, lobby, func, variant=None):
+        key = (lobby, variant)
+        future = self._pending.get(key)
+        if future is not None:
+            return await asyncio.shield(future), False
+        future = asyncio.get_running_loop().create_future()
+        self._pending[key] = future
+        try:
+            await asyncio.sleep(self.debounce)
+            async with self._locks.setdefault(lobby, asyncio.Lock()):
+                result = func()
+                if inspect.isawaitable(result):
+                    result = await result
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            # 相乗りした要求が無くても「取り出されなかった例外」として警告されないようにする
+            future.exception()
+            raise
+        else:
+            future.set_result(result)
+        finally:
+            if self._pending.get(key) is future:
+                del self._pending[key]
+            self._release_lock(lobby)
+        return result, True
+
+    # ロックを待つ・持つ要求は必ず _pending にキーがあるので、キーが残っていないロビーのロックは捨ててよい
+    def _release_lock(self, lobby):
+        lock = self._locks.get(lobby)
+        if lock is not None and not lock.locked() and not any(k[0] == lobby for k in self._pending):
+            del self._locks[lobby]
@@ -0,0 +1,123 @@
+import csv
+import io
+import json
+import re
+
+# --- 登録メンバーの一括インポート・エクスポート ---
+# CSV: 1行目はヘッダー。name, power は必須、TOP / JG / MID / ADC / SUP (レーン別パワー) と
+#      prefs (希望レーンを / か , で区切る) は任意。display_name はエクスポート時の参考用で、読み込みでは無視する
+# JSON: [{"name": ..., "power": ..., "powers": {レーン: パワー}, "prefs": [レーン, ...]}, ...]
+# レーン別パワーか希望レーンのある行は、そのメンバーのロール情報をファイルの内容で置き換える
+ROSTER_FORMATS = ("csv", "json")
+MAX_ROSTER_FILE_SIZE = 1024 * 1024
+
+def roster_format(filename):
+    ext = filename.rsplit(".", 1)[-1].lower() if "." in filename else ""
+    return ext if ext in ROSTER_FORMATS else None
+
+# (行番号, 項目の辞書) を1行ずつ返す。CSV はバイト列を先頭から順に読み、全体を文字列にしない
+def _iter_rows(fmt, data, lanes):
+    # Excel で保存した CSV の BOM も読めるよう utf-8-sig で読む
+    text = io.TextIOWrapper(io.BytesIO(data), encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text)
+        fields = {(key or "").strip() for key in reader.fieldnames or ()}
+        if not {'name', 'power'} <= fields:
+            raise ValueError("1行目のヘッダーに name と power が必要です")
+        for row in reader:
+            row = {(key or "").strip(): (value or "").strip() for key, value in row.items() if key}
+            powers = {key.upper(): row[key] for key in row if key.upper() in lanes and row[key]}
+            prefs = [lane.strip() for lane in row.get('prefs', "").replace("/", ",").split(",") if lane.strip()]
+            yield reader.line_num, {'name': row.get('name', ""), 'power': row.get('power', ""),
+                                    'powers': powers, 'prefs': prefs}
+        return
+    rows = json.load(text)
+    if not isinstance(rows, list):
+        raise ValueError("JSON はメンバーのリストで指定してください")
+    for i, row in enumerate(rows, start=1):
+        yield i, row
+
+# 整数 (bool を除く) か整数の文字列だけを受け付ける。1.5 や true、1e400、"+-5"、"²" は不正とする
+INT_PATTERN = re.compile(r"[+-]?[0-9]+")
+
+def _parse_int(value):
+    if isinstance(value, int) and not isinstance(value, bool):
+        return value
+    if isinstance(value, str) and INT_PATTERN.fullmatch(value.strip()):
+        return int(value)
+    raise ValueError
+
+def _parse_row(row, lane_aliases):
+    if not isinstance(row, dict):
+        raise ValueError("形式が不正です")
+    name = str(row.get('name') or "").strip()
+    if not name:
+        raise ValueError("名前がありません")
+    try:
+        power = _parse_int(row.get('power'))
+    except ValueError:
+        raise ValueError(f"パワーが整数ではありません: {row.get('power')}") from None
+    powers, prefs = row.get('powers') or {}, row.get('prefs') or []
+    if not isinstance(powers, dict) or not isinstance(prefs, list):
+        raise ValueError("レーン別パワー・希望レーンの形式が不正です")
+    role = None
+    if powers or prefs:
+        role = {'powers': {}, 'prefs': []}
+        for lane, value in powers.items():
+            if str(lane).upper() not in lane_aliases:
+                raise ValueError(f"不明なレーンです: {lane}")
+            try:
+                role['powers'][lane_aliases[str(lane).upper()]] = _parse_int(value)
+            except ValueError:
+                raise ValueError(f"{lane} のパワーが整数ではありません: {value}") from None
+        for lane in prefs:
+            if str(lane).upper() not in lane_aliases:
+                raise ValueError(f"不明なレーンです: {lane}")
+            role['prefs'].append(lane_aliases[str(lane).upper()])
+    return name, power, role
+
+# ファイル全体を検証し、({名前: (パワー, ロール情報または None)}, [(行番号, 理由)]) を返す。
+# normalize は名前の正規化 (メンションからユーザーIDを取り出すなど)。同じ名前が複数ある場合は後の行を不正とする
+def read_roster(fmt, data, lane_aliases, normalize=str):
+    rows, rejected = {}, []
+    lanes = set(lane_aliases)
+    try:
+        for line, row in _iter_rows(fmt, data, lanes):
+            try:
+                name, power, role = _parse_row(row, lane_aliases)
+            except ValueError as e:
+                rejected.append((line, str(e)))
+                continue
+            name = normalize(name)
+            if name in rows:
+                rejected.append((line, f"名前が重複しています: {name}"))
+                continue
+            rows[name] = (power, role)
+    except (UnicodeDecodeError, csv.Error, json.JSONDecodeError) as e:
+        raise ValueError(f"ファイルを読み込めませんでした: {e}") from None
+    return rows, rejected
+
+# members / roles をファイルの内容 (バイト列) に変換する。display_names は名前のリスト -> 表示名のリスト
+def write_roster(fmt, members, roles, lanes, display_names):
+    names = sorted(members, key=lambda n: (-members[n], n))
+    shown = display_names(names)
+    if fmt == "json":
+        rows = []
+        for name, display_name in zip(names, shown):
+            row = {'name': name, 'display_name': display_name, 'power': members[name]}
+            role = roles.get(name)
+            if role:
+                row['powers'] = dict(role.get('powers') or {})
+                row['prefs'] = list(role.get('prefs') or [])
+            rows.append(row)
+        return json.dumps(rows, ensure_ascii=False, indent=2).encode("utf-8")
+    out = io.StringIO()
+    writer = csv.writer(out)
+    writer.writerow(["name", "display_name", "power", *lanes, "prefs"])
+    for name, display_name in zip(names, shown):
+        role = roles.get(name) or {}
+        powers = role.get('powers') or {}
+        writer.writerow([name, display_name, members[name], *(powers.get(lane, "") for lane in lanes),
+                         "/".join(role.get('prefs') or [])])
+    # Excel でも文字化けしないよう BOM を付ける
+    return out.getvalue().encode("utf-8-sig")
@@ -0,0 +1,65 @@
+import asyncio
+import multiprocessing
+import threading
+from concurrent.futures import BrokenExecutor, ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+
+# --- 探索の実行先 ---
+# チーム分けの探索は CPU を使い続けるため、イベントループ上で実行するとハートビートや他のコマンドが止まる。
+# mode="process": プロセスプールで実行する (GIL に縛られず、探索中もイベントループは止まらない)
+# mode="thread": スレッドプールで実行する (純 Python の探索は GIL を手放さないが、一定間隔でループにも実行が回る)
+# mode="inline": その場で実行する (計測・デバッグ用)
+# プロセスプールに渡す関数は module の関数、引数と戻り値は pickle できるものに限る
+SEARCH_MODES = ("process", "thread", "inline")
+
+class SearchPool:
+    def __init__(self, mode="process", workers=None):
+        if mode not in SEARCH_MODES:
+            raise ValueError(f"探索の実行先の指定が不正です: {mode}")
+        self.mode = mode
+        self.workers = workers
+        self._executor = None
+        self._lock = threading.Lock()
+
+    # プールは最初の探索のときに作る (import 時にプロセスを起動しない)。
+    # イベントループと Flask のスレッドの両方から呼ばれるためロックを取る
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                if self.mode == "process":
+                    # fork は Flask や書き込みスレッドのロックの状態まで引き継ぐため spawn で起動する
+                    self._executor = ProcessPoolExecutor(self.workers,
+                                                         mp_context=multiprocessing.get_context("spawn"))
+                else:
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix="search")
+            return self._executor
+
+    async def run(self, func, *args, **kwargs):
+        if self.mode == "inline":
+            return func(*args, **kwargs)
+        executor = self._get_executor()
+        try:
+            return await asyncio.get_running_loop().run_in_executor(executor, partial(func, *args, **kwargs))
+        except BrokenExecutor:
+            # ワーカーが異常終了したプールは使えないため、次の探索で作り直す
+            if self._executor is executor:
+                self._executor = None
+            raise
+
+    # イベントループの外 (Flask のスレッドなど) から複数の入力をまとめて処理する。結果は入力の順に返す
+    def map(self, func, *iterables, chunksize=1):
+        if self.mode == "inline":
+            return list(map(func, *iterables))
+        executor = self._get_executor()
+        try:
+            # chunksize はプロセスプールでだけ使われる (まとめて送ることで受け渡しの回数を減らす)
+            return list(executor.map(func, *iterables, chunksize=chunksize))
+        except BrokenExecutor:
+            if self._executor is executor:
+                self._executor = None
+            raise
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
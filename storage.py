@@ -0,0 +1,310 @@
+import base64
+import json
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+HISTORY_WINDOW = 10
+
+# --- 保存先 (ストレージ) ---
+# ギルドごとの members / history / settings を読み書きする。書き込みは WriteBehindWriter から
+# executor 上で呼ばれるため、実装はスレッドから呼ばれても安全である必要がある。
+# history のキーは new_history_keys で作る時刻順の連番で、キー順に並べると古い順になる。
+# history は追記のみで全件を残し、累計 (stats) は {'matches': {名前: 試合数},
+# 'pairs': {(名前a, 名前b): 同じチームになった回数}} の形で読み書きする。
+# roles は {名前: {'powers': {レーン: パワー}, 'prefs': [希望レーン]}}
+class Storage:
+    def get_members(self, guild_id):
+        raise NotImplementedError
+
+    # changes は {名前: パワー}。値が None のメンバーは削除する
+    def update_members(self, guild_id, changes):
+        raise NotImplementedError
+
+    # limit が None なら全件を返す
+    def get_history(self, guild_id, limit=HISTORY_WINDOW):
+        raise NotImplementedError
+
+    # entries は {キー: [チーム1の名前一覧, チーム2の名前一覧]}
+    def append_history(self, guild_id, entries):
+        raise NotImplementedError
+
+    def get_settings(self, guild_id):
+        raise NotImplementedError
+
+    def update_settings(self, guild_id, changes):
+        raise NotImplementedError
+
+    def get_roles(self, guild_id):
+        raise NotImplementedError
+
+    # changes は {名前: ロール情報}。値が None のメンバーは削除する
+    def update_roles(self, guild_id, changes):
+        raise NotImplementedError
+
+    def get_stats(self, guild_id):
+        raise NotImplementedError
+
+    # changes は {('matches', 名前): 試合数, ('pairs', 名前a, 名前b): 回数} の形で、
+    # 変更のあった値 (更新後の値) だけを含む
+    def update_stats(self, guild_id, changes):
+        raise NotImplementedError
+
+    # ギルドに属さない bot 全体の値 (スラッシュコマンド定義のハッシュなど)
+    def get_meta(self, key):
+        raise NotImplementedError
+
+    def set_meta(self, key, value):
+        raise NotImplementedError
+
+    def load_guild(self, guild_id):
+        return (self.get_members(guild_id), self.get_history(guild_id),
+                self.get_settings(guild_id), self.get_stats(guild_id), self.get_roles(guild_id))
+
+    def close(self):
+        pass
+
+_history_key_lock = threading.Lock()
+_last_history_key = 0
+
+def new_history_keys(count):
+    global _last_history_key
+    keys = []
+    with _history_key_lock:
+        for _ in range(count):
+            _last_history_key = max(_last_history_key + 1, time.time_ns())
+            keys.append(f"{_last_history_key:020d}")
+    return keys
+
+# --- Firebase Realtime Database ---
+# データは guilds/{ギルドID}/members|history|settings|stats|roles に保存する。
+# legacy_guild_id のギルドは、初回読み込み時に旧形式 (ルート直下) のデータを引き継ぐ。
+# 認証情報はファイルに書き出さずメモリ上で読み込む。
+# db に firebase_admin.db と同じ reference(path) を持つオブジェクトを渡すと、接続せずにそれを使う (負荷試験用)
+class FirebaseStorage(Storage):
+    def __init__(self, cred_base64=None, db_url=None, legacy_guild_id=None, db=None):
+        if db is None:
+            import firebase_admin
+            from firebase_admin import credentials, db
+            cred = credentials.Certificate(json.loads(base64.b64decode(cred_base64)))
+            firebase_admin.initialize_app(cred, {'databaseURL': db_url})
+        self.db = db
+        self.legacy_guild_id = legacy_guild_id
+        self.pool = ThreadPoolExecutor(max_workers=4)
+
+    def ref(self, guild_id, node):
+        return self.db.reference(f'guilds/{guild_id}/{node}')
+
+    def get_members(self, guild_id):
+        return self.ref(guild_id, 'members').get() or {}
+
+    def update_members(self, guild_id, changes):
+        self.ref(guild_id, 'members').update(changes)
+
+    def get_history(self, guild_id, limit=HISTORY_WINDOW):
+        query = self.ref(guild_id, 'history').order_by_key()
+        if limit is not None:
+            query = query.limit_to_last(limit)
+        return self._history_entries(query.get())
+
+    def append_history(self, guild_id, entries):
+        self.ref(guild_id, 'history').update(entries)
+
+    def get_settings(self, guild_id):
+        return self.ref(guild_id, 'settings').get() or {}
+
+    def update_settings(self, guild_id, changes):
+        self.ref(guild_id, 'settings').update(changes)
+
+    def get_roles(self, guild_id):
+        return self.ref(guild_id, 'roles').get() or {}
+
+    def update_roles(self, guild_id, changes):
+        self.ref(guild_id, 'roles').update(changes)
+
+    # stats/matches/{名前} と stats/pairs/{名前a}/{名前b} に保存する
+    def get_stats(self, guild_id):
+        data = self.ref(guild_id, 'stats').get() or {}
+        pairs = {(a, b): count for a, counts in (data.get('pairs') or {}).items() for b, count in counts.items()}
+        return {'matches': data.get('matches') or {}, 'pairs': pairs}
+
+    def update_stats(self, guild_id, changes):
+        if changes:
+            self.ref(guild_id, 'stats').update({"/".join(key): count for key, count in changes.items()})
+
+    def get_meta(self, key):
+        return self.db.reference(f'meta/{key}').get()
+
+    def set_meta(self, key, value):
+        self.db.reference(f'meta/{key}').set(value)
+
+    @staticmethod
+    def _history_entries(data):
+        if not data:
+            return []
+        entries = data.values() if isinstance(data, dict) else data
+        return [t for t in entries if t]
+
+    # members / history / settings / stats / roles の各ノードは並行して取得する
+    def load_guild(self, guild_id):
+        members, history, settings, stats, roles = self.pool.map(
+            lambda read: read(guild_id),
+            (self.get_members, self.get_history, self.get_settings, self.get_stats, self.get_roles))
+        if not (members or history or settings) and str(guild_id) == self.legacy_guild_id:
+            members = self.db.reference('members').get() or {}
+            history = self._history_entries(self.db.reference('history').get())[-HISTORY_WINDOW:]
+            settings = self.db.reference('settings').get() or {}
+            self.ref(guild_id, 'members').set(members)
+            self.ref(guild_id, 'settings').set(settings)
+            self.ref(guild_id, 'history').set(dict(zip(new_history_keys(len(history)), history)))
+        return members, history, settings, stats, roles
+
+    def close(self):
+        self.pool.shutdown(wait=False)
+
+# --- SQLite (WAL モード) ---
+# ネットワークを介さないローカル保存。オフラインでの動作確認や小規模な自前運用向け。
+# 接続は1つを共有し、スレッド間の排他はロックで行う。複数キーの変更は1トランザクションで反映する
+class SQLiteStorage(Storage):
+    def __init__(self, path="teambot.sqlite3"):
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.lock = threading.Lock()
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("PRAGMA synchronous=NORMAL")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS members ("
+                "guild_id TEXT NOT NULL, name TEXT NOT NULL, power INTEGER NOT NULL, "
+                "PRIMARY KEY (guild_id, name))")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS history ("
+                "guild_id TEXT NOT NULL, key TEXT NOT NULL, entry TEXT NOT NULL, "
+                "PRIMARY KEY (guild_id, key))")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS settings ("
+                "guild_id TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, "
+                "PRIMARY KEY (guild_id, key))")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS player_stats ("
+                "guild_id TEXT NOT NULL, name TEXT NOT NULL, matches INTEGER NOT NULL, "
+                "PRIMARY KEY (guild_id, name))")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS pair_stats ("
+                "guild_id TEXT NOT NULL, a TEXT NOT NULL, b TEXT NOT NULL, count INTEGER NOT NULL, "
+                "PRIMARY KEY (guild_id, a, b))")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS roles ("
+                "guild_id TEXT NOT NULL, name TEXT NOT NULL, data TEXT NOT NULL, "
+                "PRIMARY KEY (guild_id, name))")
+            self.conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+
+    def get_members(self, guild_id):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT name, power FROM members WHERE guild_id = ?", (str(guild_id),)).fetchall()
+        return dict(rows)
+
+    def update_members(self, guild_id, changes):
+        guild_id = str(guild_id)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM members WHERE guild_id = ? AND name = ?",
+                [(guild_id, name) for name, power in changes.items() if power is None])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO members (guild_id, name, power) VALUES (?, ?, ?)",
+                [(guild_id, name, power) for name, power in changes.items() if power is not None])
+
+    def get_history(self, guild_id, limit=HISTORY_WINDOW):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT entry FROM history WHERE guild_id = ? ORDER BY key DESC LIMIT ?",
+                (str(guild_id), -1 if limit is None else limit)).fetchall()
+        return [json.loads(entry) for entry, in reversed(rows)]
+
+    def append_history(self, guild_id, entries):
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO history (guild_id, key, entry) VALUES (?, ?, ?)",
+                [(str(guild_id), key, json.dumps(entry, ensure_ascii=False)) for key, entry in entries.items()])
+
+    def get_settings(self, guild_id):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT key, value FROM settings WHERE guild_id = ?", (str(guild_id),)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
+
+    def update_settings(self, guild_id, changes):
+        guild_id = str(guild_id)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM settings WHERE guild_id = ? AND key = ?",
+                [(guild_id, key) for key, value in changes.items() if value is None])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO settings (guild_id, key, value) VALUES (?, ?, ?)",
+                [(guild_id, key, json.dumps(value)) for key, value in changes.items() if value is not None])
+
+    def get_roles(self, guild_id):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT name, data FROM roles WHERE guild_id = ?", (str(guild_id),)).fetchall()
+        return {name: json.loads(data) for name, data in rows}
+
+    def update_roles(self, guild_id, changes):
+        guild_id = str(guild_id)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "DELETE FROM roles WHERE guild_id = ? AND name = ?",
+                [(guild_id, name) for name, data in changes.items() if data is None])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO roles (guild_id, name, data) VALUES (?, ?, ?)",
+                [(guild_id, name, json.dumps(data, ensure_ascii=False))
+                 for name, data in changes.items() if data is not None])
+
+    def get_stats(self, guild_id):
+        with self.lock:
+            matches = self.conn.execute(
+                "SELECT name, matches FROM player_stats WHERE guild_id = ?", (str(guild_id),)).fetchall()
+            pairs = self.conn.execute(
+                "SELECT a, b, count FROM pair_stats WHERE guild_id = ?", (str(guild_id),)).fetchall()
+        return {'matches': dict(matches), 'pairs': {(a, b): count for a, b, count in pairs}}
+
+    def update_stats(self, guild_id, changes):
+        guild_id = str(guild_id)
+        with self.lock, self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO player_stats (guild_id, name, matches) VALUES (?, ?, ?)",
+                [(guild_id, key[1], count) for key, count in changes.items() if key[0] == 'matches'])
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO pair_stats (guild_id, a, b, count) VALUES (?, ?, ?, ?)",
+                [(guild_id, key[1], key[2], count) for key, count in changes.items() if key[0] == 'pairs'])
+
+    def get_meta(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def set_meta(self, key, value):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, json.dumps(value)))
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+# 環境変数 STORAGE_BACKEND (firebase / sqlite) から保存先を作る
+def create_storage():
+    backend = os.environ.get("STORAGE_BACKEND", "firebase")
+    if backend == "sqlite":
+        return SQLiteStorage(os.environ.get("SQLITE_PATH", "teambot.sqlite3"))
+    if backend != "firebase":
+        raise ValueError(f"STORAGE_BACKEND の値が不正です: {backend}")
+    firebase_cred_base64 = os.environ.get("FIREBASE_CRED_BASE64")
+    if not firebase_cred_base64:
+        raise ValueError("環境変数 FIREBASE_CRED_BASE64 が設定されていません")
+    firebase_db_url = os.environ.get("FIREBASE_DB_URL")
+    if not firebase_db_url:
+        raise ValueError("環境変数 FIREBASE_DB_URL が設定されていません")
+    return FirebaseStorage(firebase_cred_base64, firebase_db_url, os.environ.get("LEGACY_GUILD_ID"))
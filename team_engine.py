@@ -0,0 +1,597 @@
+import heapq
+import itertools
+import random
+import time
+from functools import lru_cache
+
+TEAM_SIZE = 5
+TOP_K = 5
+
+# --- 分割候補の事前計算 ---
+# 先頭のプレイヤー(ビット0)を常にチーム1に固定することで、
+# チーム1/チーム2を入れ替えただけの鏡像の分割を除外する (10人なら252通り→126通り)。
+# 人数の異なる2チームに分ける場合は鏡像が存在しないので固定しない
+@lru_cache(maxsize=None)
+def canonical_splits(n, team_size=TEAM_SIZE):
+    if team_size * 2 == n:
+        combs = ((0,) + comb for comb in itertools.combinations(range(1, n), team_size - 1))
+    else:
+        combs = itertools.combinations(range(n), team_size)
+    splits = []
+    for idx in combs:
+        mask = 0
+        for i in idx:
+            mask |= 1 << i
+        splits.append((mask, idx))
+    return tuple(splits)
+
+def mask_to_teams(names, mask):
+    team1 = frozenset(n for i, n in enumerate(names) if mask >> i & 1)
+    team2 = frozenset(n for i, n in enumerate(names) if not mask >> i & 1)
+    return team1, team2
+
+def split_power_diffs(powers, team_size=TEAM_SIZE, splits=None):
+    total = sum(powers)
+    if splits is None:
+        splits = canonical_splits(len(powers), team_size)
+    return [abs(2 * sum(powers[i] for i in idx) - total) for _, idx in splits]
+
+# --- 同じチーム・別チームの制約 ---
+# same: 同じチームにする名前の組のリスト / diff: 互いに別のチームにする名前の組のリスト /
+# captains: 先頭から順にチーム1, チーム2, ... に固定する名前
+class TeamConstraints:
+    def __init__(self, same=(), diff=(), captains=()):
+        self.same = [frozenset(group) for group in same if len(group) > 1]
+        self.diff = [frozenset(group) for group in diff if len(group) > 1]
+        self.captains = list(captains)
+
+    def __bool__(self):
+        return bool(self.same or self.diff or self.captains)
+
+    def names(self):
+        return set().union(*self.same, *self.diff, self.captains)
+
+# 制約を「必ず同じチームになるまとまり (unit)」単位に変換する。
+# 戻り値は (まとまりごとのプレイヤー番号, プレイヤー番号 -> まとまり, まとまり -> 固定するチーム,
+# まとまり -> 別チームにすべきまとまりの集合)
+def _constraint_units(names, constraints, team_count):
+    position = {n: i for i, n in enumerate(names)}
+    if not constraints.names() <= position.keys():
+        raise ValueError("参加者以外のメンバーが指定されています")
+    parent = list(range(len(names)))
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    for group in constraints.same:
+        first, *rest = (position[n] for n in group)
+        for i in rest:
+            parent[find(i)] = find(first)
+    roots = {}
+    for i in range(len(names)):
+        roots.setdefault(find(i), []).append(i)
+    units = list(roots.values())
+    unit_of = [0] * len(names)
+    for u, players in enumerate(units):
+        for i in players:
+            unit_of[i] = u
+
+    conflicts = [set() for _ in units]
+    for group in constraints.diff:
+        group_units = [unit_of[position[n]] for n in group]
+        if len(set(group_units)) < len(group_units):
+            raise ValueError("同じチームにする指定と別チームにする指定が矛盾しています")
+        if len(group_units) > team_count:
+            raise ValueError(f"別チームにするメンバーは1組{team_count}人までです")
+        for a, b in itertools.permutations(group_units, 2):
+            conflicts[a].add(b)
+
+    if len(constraints.captains) > team_count:
+        raise ValueError(f"キャプテンは{team_count}人までです")
+    fixed = {}
+    for team, name in enumerate(constraints.captains):
+        u = unit_of[position[name]]
+        if u in fixed:
+            raise ValueError("キャプテン同士を同じチームにすることはできません")
+        fixed[u] = team
+    return units, unit_of, fixed, conflicts
+
+# 制約を満たす2チーム分割だけを (mask, idx) で列挙する。
+# 制約に関わるまとまりだけを深さ優先で割り当て、人数の上限や別チーム指定に反する時点で枝を刈り、
+# 残りの制約のないプレイヤーは空いている枠の数だけ itertools.combinations で選ぶ。
+# そのため制約が多いほど列挙数・計算量が減る。キャプテンの指定がなければ canonical_splits と同様に鏡像を除外する
+def constrained_splits(names, team_size, constraints):
+    names = list(names)
+    n = len(names)
+    units, unit_of, fixed, conflicts = _constraint_units(names, constraints, 2)
+    if team_size * 2 == n and not fixed:
+        fixed = {unit_of[0]: 0}
+    capacity = (team_size, n - team_size)
+    bound = [u for u in range(len(units)) if u in fixed or conflicts[u] or len(units[u]) > 1]
+    free = [units[u][0] for u in range(len(units)) if u not in bound]
+    # 固定されたまとまり、別チーム指定のあるまとまり、大きいまとまりの順に割り当てて早めに枝を刈る
+    bound.sort(key=lambda u: (u not in fixed, not conflicts[u], -len(units[u])))
+    rank = {u: pos for pos, u in enumerate(bound)}
+    choices = [(fixed[u],) if u in fixed else (0, 1) for u in bound]
+    # 並べ替え後の位置で、先に割り当て済みの別チーム指定の相手だけを持つ
+    earlier = [[rank[v] for v in conflicts[u] if rank[v] < pos] for pos, u in enumerate(bound)]
+    team_at = [0] * len(bound)
+    splits = []
+
+    def assign(pos, team1, filled1, filled2):
+        if pos == len(bound):
+            need = capacity[0] - filled1
+            if need <= len(free) and capacity[1] - filled2 == len(free) - need:
+                for comb in itertools.combinations(free, need):
+                    idx = tuple(sorted(team1 + comb))
+                    splits.append((sum(1 << i for i in idx), idx))
+            return
+        players = units[bound[pos]]
+        for team in choices[pos]:
+            if (filled1 if team == 0 else filled2) + len(players) > capacity[team]:
+                continue
+            if any(team_at[q] == team for q in earlier[pos]):
+                continue
+            team_at[pos] = team
+            if team == 0:
+                assign(pos + 1, team1 + tuple(players), filled1 + len(players), filled2)
+            else:
+                assign(pos + 1, team1, filled1, filled2 + len(players))
+
+    assign(0, (), 0, 0)
+    return splits
+
+# --- 上位候補の抽出 ---
+# repeat_score は分割のビットマスクを受け取り重複スコアを返す関数。
+# splits を省略すると canonical_splits の全分割 (制約がある場合は constrained_splits の結果を渡す)。
+# team_strength (チームのビットマスク -> 戦力) を渡すとパワーの合計の代わりに使う (LaneAssigner.strength)。
+# 全候補をソートせず、ヒープから良い順に必要な分だけ取り出す。取り出し途中の状態を保持しておけば、
+# 引き直し (reroll) のときに再計算せず次点の分割を取り出せる。
+# time_budget (秒) を渡すと分割をランダムな順に評価し、時間切れの時点までに評価した分割だけを順位付けする。
+# 評価した数は explored、全体の数は total に残す
+class RankedSplits:
+    BUDGET_CHECK_INTERVAL = 64
+
+    def __init__(self, names, members, repeat_score=None, team_size=TEAM_SIZE, splits=None, team_strength=None,
+                 time_budget=None, rng=random):
+        self.names = list(names)
+        powers = [members.get(n, 0) for n in self.names]
+        if splits is None:
+            splits = canonical_splits(len(self.names), team_size)
+        self.total = len(splits)
+        deadline = None
+        if time_budget is not None:
+            deadline = time.perf_counter() + time_budget
+            splits = list(splits)
+            rng.shuffle(splits)
+        full = (1 << len(self.names)) - 1
+        diffs, scores = [], []
+        for start in range(0, len(splits), self.BUDGET_CHECK_INTERVAL):
+            if start and deadline is not None and time.perf_counter() > deadline:
+                splits = splits[:start]
+                break
+            chunk = splits[start:start + self.BUDGET_CHECK_INTERVAL]
+            if team_strength is None:
+                diffs += split_power_diffs(powers, team_size, chunk)
+            else:
+                diffs += [abs(team_strength(mask) - team_strength(full ^ mask)) for mask, _ in chunk]
+            if repeat_score is None:
+                scores += [0] * len(chunk)
+            else:
+                scores += [repeat_score(mask) for mask, _ in chunk]
+        self.explored = len(splits)
+        self._masks = [mask for mask, _ in splits]
+        self._heap = [(scores[j], diffs[j], j) for j in range(len(splits))]
+        heapq.heapify(self._heap)
+
+    def __len__(self):
+        return len(self._heap)
+
+    def pop(self):
+        if not self._heap:
+            return None
+        score, diff, j = heapq.heappop(self._heap)
+        team1, team2 = mask_to_teams(self.names, self._masks[j])
+        return {
+            'team1': team1,
+            'team2': team2,
+            'diff': diff,
+            'repeat_score': score
+        }
+
+    def take(self, k):
+        return [self.pop() for _ in range(min(k, len(self._heap)))]
+
+def rank_splits(names, members, k=TOP_K, repeat_score=None, team_size=TEAM_SIZE, splits=None,
+                team_strength=None, time_budget=None):
+    return RankedSplits(names, members, repeat_score, team_size, splits, team_strength, time_budget).take(k)
+
+# --- レーン割り当て ---
+# roles は {名前: {'powers': {レーン: パワー}, 'prefs': [希望レーン]}}。
+# レーン別パワーの無いレーンは members のパワーを使い、希望レーン以外では off_role_penalty を引く。
+# チームの戦力は、チーム内でレーンを1人1つずつ割り当てたときの合計の最大値とする
+LANES = ('TOP', 'JG', 'MID', 'ADC', 'SUP')
+
+def lane_powers(name, members, roles, off_role_penalty, lanes=LANES):
+    role = roles.get(name) or {}
+    powers = role.get('powers') or {}
+    prefs = role.get('prefs') or ()
+    base = members.get(name, 0)
+    return [powers.get(lane, base) - (off_role_penalty if prefs and lane not in prefs else 0) for lane in lanes]
+
+# 全員分のビット集合 S について「S の人数分の先頭レーンを S に割り当てたときの最大値」を
+# best[S] = max(best[S - p] + w[p][|S| - 1]) で一度だけ求める (ビットマスク DP)。
+# チーム (人数 = レーン数) の戦力は best[チームのマスク] で引けるため、
+# 126通りの分割 × 各チーム 120通りのレーン順列を試す必要がない
+class LaneAssigner:
+    def __init__(self, names, members, roles, off_role_penalty, lanes=LANES):
+        self.names = list(names)
+        self.lanes = lanes
+        weights = [lane_powers(n, members, roles, off_role_penalty, lanes) for n in self.names]
+        self.best = {0: 0}
+        self.choice = {}
+        for mask in range(1, 1 << len(self.names)):
+            count = bin(mask).count("1")
+            if count > len(lanes):
+                continue
+            lane = count - 1
+            best_value, best_player = None, None
+            for p, w in enumerate(weights):
+                if mask >> p & 1:
+                    value = self.best[mask ^ (1 << p)] + w[lane]
+                    if best_value is None or value > best_value:
+                        best_value, best_player = value, p
+            self.best[mask] = best_value
+            self.choice[mask] = best_player
+
+    def strength(self, mask):
+        return self.best[mask]
+
+    def team_mask(self, team):
+        return sum(1 << i for i, n in enumerate(self.names) if n in team)
+
+    # チームの名前の集合 -> {名前: レーン}
+    def assign(self, team):
+        mask = self.team_mask(team)
+        assignment = {}
+        while mask:
+            p = self.choice[mask]
+            assignment[self.names[p]] = self.lanes[bin(mask).count("1") - 1]
+            mask ^= 1 << p
+        return assignment
+
+# --- 前回とのチーム番号の入れ替え ---
+# 前回と同じチーム番号になる顔ぶれが少なくなる向きを選ぶ
+def count_overlap(set1, set2):
+    return len(set1.intersection(set2))
+
+def decide_swap(team1, team2, prev_team1, prev_team2):
+    overlap_normal = count_overlap(team1, prev_team1) + count_overlap(team2, prev_team2)
+    overlap_swapped = count_overlap(team1, prev_team2) + count_overlap(team2, prev_team1)
+    if overlap_swapped < overlap_normal:
+        return team2, team1
+    else:
+        return team1, team2
+
+# --- 履歴インデックス ---
+# 直近の履歴ほど重くなる重み (6件目以降は1)
+REPEAT_WEIGHTS = [100, 10, 5, 2, 1]
+
+def recency_weight(idx):
+    return REPEAT_WEIGHTS[idx] if idx < len(REPEAT_WEIGHTS) else 1
+
+# history が変わったときに一度だけ構築し、ロールごとの全履歴走査をなくす。
+# split_weights: 分割 {チーム1, チーム2} -> 同じ分割が出たときの重みの合計
+# pair_weights: (名前a, 名前b) -> 同じチームになったときの重みの合計
+class HistoryIndex:
+    def __init__(self, history=()):
+        self.split_weights = {}
+        self.pair_weights = {}
+        for idx, (team1, team2) in enumerate(reversed(list(history))):
+            weight = recency_weight(idx)
+            key = frozenset((frozenset(team1), frozenset(team2)))
+            self.split_weights[key] = self.split_weights.get(key, 0) + weight
+            for team in (team1, team2):
+                for pair in itertools.combinations(sorted(team), 2):
+                    self.pair_weights[pair] = self.pair_weights.get(pair, 0) + weight
+
+    def repeat_score(self, team1, team2):
+        weight = self.split_weights.get(frozenset((frozenset(team1), frozenset(team2))), 0)
+        return weight * (len(team1) + len(team2))
+
+    # names の並びでのビットマスク -> 重複スコアの表を作り、rank_splits 用の関数を返す
+    def mask_scorer(self, names):
+        names = list(names)
+        position = {n: i for i, n in enumerate(names)}
+        table = {}
+        for key, weight in self.split_weights.items():
+            team1, team2 = tuple(key) if len(key) == 2 else (next(iter(key)), frozenset())
+            if len(team1) + len(team2) != len(names) or not all(n in position for n in team1 | team2):
+                continue
+            # ビット0のプレイヤーを含む側をチーム1として正規化する
+            if names[0] not in team1:
+                team1, team2 = team2, team1
+            mask = 0
+            for n in team1:
+                mask |= 1 << position[n]
+            table[mask] = table.get(mask, 0) + weight * len(names)
+        # キャプテン指定のある分割はビット0のプレイヤーがチーム2側になりうるため、補集合で引く
+        full = (1 << len(names)) - 1
+        return lambda mask: table.get(mask if mask & 1 else full ^ mask, 0)
+
+# --- 5v5 の候補の作成 ---
+# イベントループの外 (プロセスプール・スレッドプール) で実行できるよう、引数と戻り値は pickle できるものだけにする。
+# roles を渡すとレーン割り当て後の戦力で比べる。(RankedSplits, LaneAssigner または None) を返す
+def team_candidates(names, members, history_index=None, constraints=None, roles=None,
+                    off_role_penalty=0, time_budget=None):
+    names = list(names)
+    if constraints:
+        splits = constrained_splits(names, TEAM_SIZE, constraints)
+    else:
+        splits = canonical_splits(len(names))
+    assigner = None
+    if roles is not None:
+        assigner = LaneAssigner(names, members, roles, off_role_penalty)
+    repeat_score = history_index.mask_scorer(names) if history_index is not None else None
+    ranked = RankedSplits(names, members, repeat_score=repeat_score, splits=splits,
+                          team_strength=assigner and assigner.strength, time_budget=time_budget)
+    return ranked, assigner
+
+# 上位 k 件から1つを選び、前回 (previous) と比べてチーム番号を決める (keep_order なら入れ替えない)。
+# (選んだ候補, チーム1, チーム2, 選ばれなかった上位候補) を返し、候補が無ければ None を返す
+def pick_teams(ranked, previous=None, keep_order=False, k=TOP_K, rng=random):
+    top_candidates = ranked.take(k)
+    if not top_candidates:
+        return None
+    selected = rng.choice(top_candidates)
+    team1 = selected['team1']
+    team2 = selected['team2']
+    if previous is not None and not keep_order:
+        team1, team2 = decide_swap(team1, team2, *previous)
+    return selected, team1, team2, [c for c in top_candidates if c is not selected]
+
+# 5v5 のチーム分けを1回行う (Discord・保存先に依存しない)。history は古い順の (チーム1, チーム2) のリスト。
+# キャプテン指定がある場合はチーム番号を入れ替えない
+def make_teams(names, members, history=(), constraints=None, roles=None, off_role_penalty=0,
+               time_budget=None, rng=random):
+    names = list(names)
+    if len(names) != TEAM_SIZE * 2:
+        raise ValueError(f"参加者が{TEAM_SIZE * 2}人ではありません")
+    history = [(frozenset(team1), frozenset(team2)) for team1, team2 in history]
+    ranked, assigner = team_candidates(names, members, HistoryIndex(history), constraints, roles,
+                                       off_role_penalty, time_budget)
+    picked = pick_teams(ranked, history[-1] if history else None,
+                        keep_order=bool(constraints and constraints.captains), rng=rng)
+    if picked is None:
+        raise ValueError("指定を満たすチーム分けがありません")
+    selected, team1, team2, _ = picked
+    result = {
+        'team1': team1,
+        'team2': team2,
+        'diff': selected['diff'],
+        'repeat_score': selected['repeat_score'],
+        'explored': ranked.explored,
+        'total': ranked.total,
+    }
+    if assigner is not None:
+        result['lanes'] = {**assigner.assign(team1), **assigner.assign(team2)}
+    return result
+
+# --- 10人を超える場合の探索 (複数ロビー・人数の異なるチーム) ---
+# team_sizes の隣り合う2チーム (0と1, 2と3, ...) を1つのロビーとして対戦させる。
+# 評価は (許容値を超えたパワー差の合計, 同じチームになった組の重複スコア, パワー差の合計) の辞書式順序で、
+# 候補数が EXHAUSTIVE_LIMIT 以下なら全探索、それを超える場合は time_budget 秒の反復局所探索を行う
+EXHAUSTIVE_LIMIT = 20000
+SEARCH_TIME_BUDGET = 0.3
+
+def _pair_matrix(names, history_index):
+    position = {n: i for i, n in enumerate(names)}
+    matrix = [[0] * len(names) for _ in names]
+    if history_index is not None:
+        for (a, b), weight in history_index.pair_weights.items():
+            if a in position and b in position:
+                matrix[position[a]][position[b]] = weight
+                matrix[position[b]][position[a]] = weight
+    return matrix
+
+def _team_repeat(team, matrix):
+    return sum(matrix[a][b] for a, b in itertools.combinations(team, 2))
+
+def _search_cost(diffs, repeat, tolerance):
+    return (sum(max(d - tolerance, 0) for d in diffs), repeat, sum(diffs))
+
+def _search_result(names, powers, teams, matrix, explored, exhaustive):
+    sums = [sum(powers[i] for i in team) for team in teams]
+    return {
+        'teams': [frozenset(names[i] for i in team) for team in teams],
+        'sums': sums,
+        'diffs': [abs(sums[t] - sums[t + 1]) for t in range(0, len(teams), 2)],
+        'repeat_score': sum(_team_repeat(team, matrix) for team in teams),
+        'explored': explored,
+        'exhaustive': exhaustive
+    }
+
+def _exhaustive_two_teams(names, powers, team_sizes, matrix, tolerance, splits):
+    n = len(names)
+    best = None
+    explored = 0
+    for mask, idx in splits:
+        team1 = list(idx)
+        team2 = [i for i in range(n) if not mask >> i & 1]
+        diff = abs(sum(powers[i] for i in team1) - sum(powers[i] for i in team2))
+        cost = _search_cost([diff], _team_repeat(team1, matrix) + _team_repeat(team2, matrix), tolerance)
+        explored += 1
+        if best is None or cost < best[0]:
+            best = (cost, [team1, team2])
+    if best is None:
+        raise ValueError("条件を満たすチーム分けがありません")
+    return best[1], explored
+
+# 制約のまとまり (unit) を単位に探索する。制約がなければ全員が1人ずつのまとまりになる。
+# 入れ替えは同じ人数のまとまり同士で、固定・別チーム指定に反しないものだけを試す
+def _local_search(powers, team_sizes, matrix, tolerance, deadline, rng, units, fixed, conflicts):
+    unit_power = [sum(powers[i] for i in players) for players in units]
+    # まとまり同士・まとまり内部の重複スコアを先に集計しておく
+    unit_matrix = [[sum(matrix[i][j] for i in a for j in b) for b in units] for a in units]
+    internal = sum(_team_repeat(players, matrix) for players in units)
+
+    # 初期解: 制約のあるまとまり (固定・別チーム指定・2人以上) を先に、入れられるチームのうち合計が低い順に
+    # 深さ優先で割り当て、行き詰まったら戻ってやり直す (貪欲法だけでは別チーム指定の相手が残りの枠を
+    # 埋めてしまい、解があるのに行き詰まることがある)。残りの1人ずつのまとまりは空いている枠に貪欲に入れる
+    order = sorted(range(len(units)), key=lambda u: (u not in fixed, not conflicts[u], -len(units[u]),
+                                                     -unit_power[u], rng.random()))
+    bound = [u for u in order if u in fixed or conflicts[u] or len(units[u]) > 1]
+    free = [u for u in order if not (u in fixed or conflicts[u] or len(units[u]) > 1)]
+    teams = [[] for _ in team_sizes]
+    filled = [0] * len(team_sizes)
+    sums = [0] * len(team_sizes)
+    team_of = [None] * len(units)
+
+    def place(u, t):
+        teams[t].append(u)
+        team_of[u] = t
+        filled[t] += len(units[u])
+        sums[t] += unit_power[u]
+
+    def assign(pos):
+        if pos == len(bound):
+            return True
+        u = bound[pos]
+        choices = [t for t in ((fixed[u],) if u in fixed else range(len(teams)))
+                   if filled[t] + len(units[u]) <= team_sizes[t] and all(team_of[v] != t for v in conflicts[u])]
+        for t in sorted(choices, key=lambda t: sums[t]):
+            place(u, t)
+            if assign(pos + 1):
+                return True
+            teams[t].pop()
+            team_of[u] = None
+            filled[t] -= len(units[u])
+            sums[t] -= unit_power[u]
+        return False
+
+    if not assign(0):
+        raise ValueError("条件を満たすチーム分けがありません")
+    for u in free:
+        place(u, min((t for t in range(len(teams)) if filled[t] < team_sizes[t]), key=lambda t: sums[t]))
+
+    def team_repeat(team):
+        return sum(unit_matrix[u][v] for u, v in itertools.combinations(team, 2))
+
+    def movable(u, v, a, b):
+        # u (チーム a) と v (チーム b) を入れ替えられるか
+        return (len(units[u]) == len(units[v]) and u not in fixed and v not in fixed
+                and all(w == v or team_of[w] != b for w in conflicts[u])
+                and all(w == u or team_of[w] != a for w in conflicts[v]))
+
+    def swap(a, ia, b, ib):
+        u, v = teams[a][ia], teams[b][ib]
+        teams[a][ia], teams[b][ib] = v, u
+        team_of[u], team_of[v] = b, a
+
+    repeat = internal + sum(team_repeat(team) for team in teams)
+    diffs = [abs(sums[t] - sums[t + 1]) for t in range(0, len(teams), 2)]
+    cost = _search_cost(diffs, repeat, tolerance)
+    best_cost, best_teams = cost, [team[:] for team in teams]
+    explored = 0
+
+    while time.perf_counter() < deadline:
+        improved = False
+        for a, b in itertools.combinations(range(len(teams)), 2):
+            for ia, u in enumerate(teams[a]):
+                for ib, v in enumerate(teams[b]):
+                    if not movable(u, v, a, b):
+                        continue
+                    explored += 1
+                    delta = unit_power[v] - unit_power[u]
+                    new_sums = sums[:]
+                    new_sums[a] += delta
+                    new_sums[b] -= delta
+                    new_diffs = diffs[:]
+                    for t in {a // 2, b // 2}:
+                        new_diffs[t] = abs(new_sums[2 * t] - new_sums[2 * t + 1])
+                    new_repeat = repeat
+                    new_repeat += sum(unit_matrix[v][x] - unit_matrix[u][x] for x in teams[a] if x != u)
+                    new_repeat += sum(unit_matrix[u][y] - unit_matrix[v][y] for y in teams[b] if y != v)
+                    new_cost = _search_cost(new_diffs, new_repeat, tolerance)
+                    if new_cost < cost:
+                        swap(a, ia, b, ib)
+                        sums, diffs, repeat, cost = new_sums, new_diffs, new_repeat, new_cost
+                        improved = True
+                        break
+                if improved:
+                    break
+            if improved:
+                break
+        if improved:
+            continue
+        # 局所最適に到達したら最良解を更新し、ランダムな入れ替えで揺さぶって探索を続ける
+        if cost < best_cost:
+            best_cost, best_teams = cost, [team[:] for team in teams]
+        if best_cost[0] == 0 and best_cost[1] == internal and best_cost[2] == 0:
+            break
+        teams = [team[:] for team in best_teams]
+        for t, team in enumerate(teams):
+            for u in team:
+                team_of[u] = t
+        for _ in range(rng.randint(2, 4)):
+            a, b = rng.sample(range(len(teams)), 2)
+            ia, ib = rng.randrange(len(teams[a])), rng.randrange(len(teams[b]))
+            if movable(teams[a][ia], teams[b][ib], a, b):
+                swap(a, ia, b, ib)
+        sums = [sum(unit_power[u] for u in team) for team in teams]
+        diffs = [abs(sums[t] - sums[t + 1]) for t in range(0, len(teams), 2)]
+        repeat = internal + sum(team_repeat(team) for team in teams)
+        cost = _search_cost(diffs, repeat, tolerance)
+    if cost < best_cost:
+        best_teams = teams
+    return [[i for u in team for i in units[u]] for team in best_teams], explored
+
+def _split_count(n, team_size):
+    count = 1
+    for i in range(team_size):
+        count = count * (n - i) // (i + 1)
+    return count // 2 if team_size * 2 == n else count
+
+def search_teams(names, members, team_sizes, history_index=None, tolerance=0,
+                 time_budget=SEARCH_TIME_BUDGET, rng=random, constraints=None):
+    names = list(names)
+    if sum(team_sizes) != len(names) or len(team_sizes) % 2 != 0:
+        raise ValueError("team_sizes はロビーごとの2チーム分の人数で、合計が参加者数と一致する必要があります")
+    constraints = constraints or TeamConstraints()
+    powers = [members.get(n, 0) for n in names]
+    matrix = _pair_matrix(names, history_index)
+    units, _, fixed, conflicts = _constraint_units(names, constraints, len(team_sizes))
+    # 制約でまとまった人数が多いほど分割の数は減る (まとまりの数を m とすると高々 2^m 通り)
+    if len(team_sizes) == 2 and min(_split_count(len(names), team_sizes[0]), 2 ** len(units)) <= EXHAUSTIVE_LIMIT:
+        if constraints:
+            splits = constrained_splits(names, team_sizes[0], constraints)
+        else:
+            splits = canonical_splits(len(names), team_sizes[0])
+        teams, explored = _exhaustive_two_teams(names, powers, team_sizes, matrix, tolerance, splits)
+        return _search_result(names, powers, teams, matrix, explored, True)
+    deadline = time.perf_counter() + time_budget
+    teams, explored = _local_search(powers, team_sizes, matrix, tolerance, deadline, rng, units, fixed, conflicts)
+    return _search_result(names, powers, teams, matrix, explored, False)
+
+# 参加者を team_size 対 team_size のロビーに分ける。端数の参加者はランダムに待機 (bench) になる
+# 制約に含まれる参加者は待機にしない
+def make_lobbies(names, members, history_index=None, team_size=TEAM_SIZE, tolerance=0,
+                 time_budget=SEARCH_TIME_BUDGET, rng=random, constraints=None):
+    names = list(names)
+    lobby_count = len(names) // (team_size * 2)
+    if lobby_count == 0:
+        raise ValueError(f"ロビーを作るには{team_size * 2}人以上必要です")
+    rng.shuffle(names)
+    if constraints:
+        required = constraints.names()
+        if len(required) > lobby_count * team_size * 2:
+            raise ValueError("指定したメンバーが多すぎて全員をロビーに入れられません")
+        names.sort(key=lambda n: n not in required)
+    playing = names[:lobby_count * team_size * 2]
+    result = search_teams(playing, members, [team_size] * (lobby_count * 2), history_index,
+                          tolerance, time_budget, rng, constraints)
+    result['bench'] = names[lobby_count * team_size * 2:]
+    return result
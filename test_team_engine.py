@@ -0,0 +1,111 @@
+import itertools
+import random
+
+import pytest
+
+from team_engine import TeamConstraints, canonical_splits, constrained_splits, make_lobbies, search_teams
+
+def _satisfies(teams, constraints):
+    team_of = {name: t for t, team in enumerate(teams) for name in team}
+    for group in constraints.same:
+        if len({team_of[n] for n in group}) != 1:
+            return False
+    for group in constraints.diff:
+        if len({team_of[n] for n in group}) != len(group):
+            return False
+    for t, name in enumerate(constraints.captains):
+        if team_of[name] != t:
+            return False
+    return True
+
+def _split_teams(names, mask):
+    return ([n for i, n in enumerate(names) if mask >> i & 1],
+            [n for i, n in enumerate(names) if not mask >> i & 1])
+
+# --- constrained_splits ---
+# 制約を満たす分割を漏れなく・重複なく列挙することを、全分割を絞り込んだ結果と比べて確かめる
+@pytest.mark.parametrize("n, team_size, constraints", [
+    (10, 5, TeamConstraints(same=[["p0", "p1"]], diff=[["p2", "p3"]])),
+    (10, 5, TeamConstraints(diff=[["p0", "p1"], ["p2", "p3"]], captains=["p4", "p5"])),
+    (10, 5, TeamConstraints(same=[["p1", "p2", "p3"]], captains=["p1"])),
+    (9, 4, TeamConstraints(same=[["p0", "p8"]], diff=[["p0", "p1"]])),
+    (9, 4, TeamConstraints(captains=["p3", "p7"])),
+])
+def test_constrained_splits_match_filtered_splits(n, team_size, constraints):
+    names = [f"p{i}" for i in range(n)]
+    splits = constrained_splits(names, team_size, constraints)
+    masks = [mask for mask, _ in splits]
+    assert len(masks) == len(set(masks))
+    for mask, idx in splits:
+        assert mask == sum(1 << i for i in idx)
+    if team_size * 2 == n and not constraints.captains:
+        # 鏡像を除いた分割と比べる (チームの入れ替えは同じ分割とみなす)
+        full = (1 << n) - 1
+        candidates = {mask for mask, _ in canonical_splits(n, team_size)}
+        expected = {mask for mask in candidates if _satisfies(_split_teams(names, mask), constraints)
+                    or _satisfies(_split_teams(names, full ^ mask), constraints)}
+    else:
+        expected = {sum(1 << i for i in idx) for idx in itertools.combinations(range(n), team_size)
+                    if _satisfies(_split_teams(names, sum(1 << i for i in idx)), constraints)}
+    assert set(masks) == expected
+
+def test_constrained_splits_reject_contradictions():
+    names = [f"p{i}" for i in range(10)]
+    with pytest.raises(ValueError):
+        constrained_splits(names, 5, TeamConstraints(same=[["p0", "p1"]], diff=[["p0", "p1"]]))
+    with pytest.raises(ValueError):
+        constrained_splits(names, 5, TeamConstraints(diff=[["p0", "p1", "p2"]]))
+    with pytest.raises(ValueError):
+        constrained_splits(names, 5, TeamConstraints(same=[["p0", "p1"]], captains=["p0", "p1"]))
+
+def test_constrained_splits_empty_when_units_do_not_fit():
+    names = [f"p{i}" for i in range(10)]
+    assert constrained_splits(names, 5, TeamConstraints(same=[[f"p{i}" for i in range(6)]])) == []
+
+# --- search_teams / make_lobbies (制約あり) ---
+# 解のある入力では、局所探索の初期解の作り方によらず必ず制約を満たすチーム分けを返すこと
+def test_make_lobbies_with_diff_groups_always_finds_a_split():
+    constraints = TeamConstraints(diff=[["p1", "p2", "p3"], ["p4", "p5"], ["p6", "p7"]])
+    names = [f"p{i}" for i in range(1, 21)]
+    for seed in range(100):
+        rng = random.Random(seed)
+        members = {n: rng.randint(0, 100) for n in names}
+        result = make_lobbies(names, members, time_budget=0.002, rng=rng, constraints=constraints)
+        assert len(result['teams']) == 4
+        assert all(len(team) == 5 for team in result['teams'])
+        assert _satisfies(result['teams'], constraints)
+        assert not result['bench']
+
+def test_search_teams_uneven_sizes_with_diff_pair():
+    constraints = TeamConstraints(diff=[["p1", "p2"]])
+    names = [f"p{i}" for i in range(1, 22)]
+    for seed in range(100):
+        rng = random.Random(seed)
+        members = {n: rng.randint(0, 100) for n in names}
+        result = search_teams(names, members, [10, 11], time_budget=0.002, rng=rng, constraints=constraints)
+        assert sorted(map(len, result['teams'])) == [10, 11]
+        assert _satisfies(result['teams'], constraints)
+
+def test_search_teams_respects_same_groups_and_captains():
+    constraints = TeamConstraints(same=[["p1", "p2", "p3"], ["p4", "p5"]], diff=[["p1", "p4"]],
+                                  captains=["p6", "p7", "p8", "p9"])
+    names = [f"p{i}" for i in range(1, 21)]
+    for seed in range(50):
+        rng = random.Random(seed)
+        members = {n: rng.randint(0, 100) for n in names}
+        result = search_teams(names, members, [5, 5, 5, 5], time_budget=0.002, rng=rng, constraints=constraints)
+        assert _satisfies(result['teams'], constraints)
+
+def test_search_teams_raises_only_when_no_split_exists():
+    names = [f"p{i}" for i in range(1, 21)]
+    members = {n: 50 for n in names}
+    # 4人・4人・4人・3人・3人のまとまりはどの2つも同じ5人チームに入らず、4チームには収まらない
+    impossible = TeamConstraints(same=[["p1", "p2", "p3", "p4"], ["p5", "p6", "p7", "p8"], ["p9", "p10", "p11", "p12"],
+                                       ["p13", "p14", "p15"], ["p16", "p17", "p18"]])
+    with pytest.raises(ValueError):
+        search_teams(names, members, [5, 5, 5, 5], time_budget=0.002, rng=random.Random(0), constraints=impossible)
+    # 4人まとまり2つと1人ずつ: 解がある
+    possible = TeamConstraints(same=[["p1", "p2", "p3", "p4"], ["p5", "p6", "p7", "p8"]], diff=[["p1", "p5"]])
+    result = search_teams(names, members, [5, 5, 5, 5], time_budget=0.002, rng=random.Random(0),
+                          constraints=possible)
+    assert _satisfies(result['teams'], possible)